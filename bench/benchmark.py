@@ -0,0 +1,557 @@
+"""Benchmark SYAK against a synthetic SiYuan workspace and a fake Anki.
+
+python bench/benchmark.py --sizes 1000 10000 100000
+
+For every size a workspace is generated, then three runs are measured with a
+fresh sync state: cold (empty Anki), no-op (nothing changed) and 1% of the
+cards edited. Everything runs in-process on localhost, no SiYuan or Anki
+is needed.
+"""
+import argparse
+import fnmatch
+import hashlib
+import json
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import syak  # noqa: E402
+
+SCHEMA = """
+create table blocks (
+    id, parent_id, root_id, hash, box, path, hpath, name, alias, memo, tag,
+    content, fcontent, markdown, length, type, subtype, ial, sort, created, updated
+);
+create index idx_blocks_id on blocks (id);
+create index idx_blocks_parent_id on blocks (parent_id);
+create index idx_blocks_root_id on blocks (root_id);
+create table refs (
+    id, def_block_id, def_block_parent_id, def_block_root_id, def_block_path,
+    block_id, root_id, box, path, content, markdown, type
+);
+create index idx_refs_def_block_id on refs (def_block_id);
+create index idx_refs_block_id on refs (block_id);
+"""
+
+CREATED = "20230101120000"
+
+
+class Workspace:
+    # a SiYuan data directory with only what SYAK reads: temp/siyuan.db and assets
+    def __init__(
+        self,
+        path,
+        cards=1000,
+        cards_per_parent=5,
+        depth=1,
+        notebooks=2,
+        docs=50,
+        math=0.3,
+        tables=0.1,
+        assets=20,
+        asset_ratio=0.2,
+        seed=0,
+    ):
+        self.path = Path(path)
+        self.rand = random.Random(seed)
+        self.counter = 0
+        self.notebooks = [
+            {"id": self.new_id(), "name": f"notebook{i}"} for i in range(notebooks)
+        ]
+        (self.path / "temp").mkdir(parents=True, exist_ok=True)
+        (self.path / "data" / "assets").mkdir(parents=True, exist_ok=True)
+        self.assets = []
+        for i in range(assets):
+            name = f"image{i}-{CREATED}-{i:07x}.png"
+            (self.path / "data" / "assets" / name).write_bytes(self.rand.randbytes(2048))
+            self.assets.append(name)
+
+        db = self.path / "temp" / "siyuan.db"
+        if db.exists():
+            db.unlink()
+        self.con = sqlite3.connect(db)
+        self.con.executescript(SCHEMA)
+        self.con.execute("pragma journal_mode = wal")
+        card_doc = self.block("d", "", self.notebooks[0]["id"], "/@card", "", content="@card")
+        doc_ids = [
+            self.block(
+                "d",
+                "",
+                self.notebooks[i % notebooks]["id"],
+                f"/topic{i % 7}/doc{i}",
+                "",
+                content=f"doc{i}",
+            )
+            for i in range(docs)
+        ]
+        for start in range(0, cards, cards_per_parent):
+            doc = self.rand.choice(doc_ids)
+            box, hpath = self.con.execute(
+                "select box, hpath from blocks where id = ?", (doc,)
+            ).fetchone()
+            parent = doc
+            for _ in range(depth):
+                parent = self.block("l", parent, box, hpath, "")
+                parent = self.block("i", parent, box, hpath, "")
+            items = []
+            for i in range(start, min(start + cards_per_parent, cards)):
+                md = self.card_markdown(i, card_doc, math, asset_ratio)
+                block = self.block("p", parent, box, hpath, md, content=f"card {i}")
+                self.con.execute(
+                    "insert into refs (id, def_block_id, block_id, box, content, type) "
+                    "values (?, ?, ?, ?, ?, ?)",
+                    (self.new_id(), card_doc, block, box, "@card", "textmark block-ref"),
+                )
+                items.append(f"* {md}")
+            parent_md = "\n".join(items)
+            if self.rand.random() < tables:
+                parent_md += "\n\n| a | b | c |\n| --- | --- | --- |\n" + "\n".join(
+                    f"| {j} | $x_{j}$ | text {j} |" for j in range(8)
+                )
+            self.con.execute(
+                "update blocks set markdown = ?, hash = ? where id = ?",
+                (parent_md, self.hash(parent_md), parent),
+            )
+        self.con.commit()
+
+    def new_id(self):
+        self.counter += 1
+        return f"{CREATED}-{self.counter:07x}"
+
+    @staticmethod
+    def hash(markdown):
+        return hashlib.sha1(markdown.encode()).hexdigest()[:7]
+
+    def block(self, type, parent, box, hpath, markdown, content=""):
+        id = self.new_id()
+        self.con.execute(
+            "insert into blocks (id, parent_id, root_id, hash, box, hpath, content, "
+            "markdown, type, updated) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (id, parent, id, self.hash(markdown), box, hpath, content, markdown, type, CREATED),
+        )
+        return id
+
+    def card_markdown(self, i, card_doc, math, asset_ratio):
+        md = f"card {i} **question** with some text {i * 7}"
+        if self.rand.random() < math:
+            md += f" $a_{i}^2 + b_{i}^2 = c^2$"
+        if self.assets and self.rand.random() < asset_ratio:
+            md += f" ![img](assets/{self.rand.choice(self.assets)})"
+        return md + f' (({card_doc} "@card"))\n{{: id="x{i}" updated="{CREATED}"}}'
+
+    def edit(self, ratio):
+        # edit a share of the cards the way SiYuan does: new markdown, hash and updated
+        now = time.strftime("%Y%m%d%H%M%S")
+        ids = [
+            x
+            for x, in self.con.execute(
+                "select block_id from refs order by random() limit ?",
+                (max(1, int(self.count() * ratio)),),
+            )
+        ]
+        self.con.executemany(
+            "update blocks set markdown = markdown || ' edited', hash = ?, updated = ? "
+            "where id = ?",
+            ((self.hash(x + now), now, x) for x in ids),
+        )
+        self.con.commit()
+        return len(ids)
+
+    def count(self):
+        return self.con.execute("select count(*) from refs").fetchone()[0]
+
+
+class FakeAnki:
+    # in-memory stand-in for the AnkiConnect actions SYAK uses
+    def __init__(self):
+        self.decks = {"Default": 1}
+        self.models = {}
+        self.model_fields = {}
+        self.notes = {}
+        self.cards = {}
+        self.media = set()
+        self.next_id = 1_000_000
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def find(self, query):
+        notes = self.notes.values()
+        for term in re.findall(r'"[^"]*"|\S+', query):
+            key, _, value = term.strip('"').partition(":")
+            if key == "note":
+                notes = [x for x in notes if x["model"] == value]
+            elif key == "nid":
+                ids = set(map(int, value.split(",")))
+                notes = [x for x in notes if x["id"] in ids]
+            elif key == "deck":
+                notes = [
+                    x
+                    for x in notes
+                    if self.cards[x["cards"][0]] == value
+                    or self.cards[x["cards"][0]].startswith(value + "::")
+                ]
+            elif key in ("tag", "-tag"):
+                notes = [
+                    x
+                    for x in notes
+                    if any(fnmatch.fnmatch(t, value) for t in x["tags"]) == (key == "tag")
+                ]
+            elif key in ("edited", "added"):
+                since = time.time() - int(value) * 86400
+                notes = [x for x in notes if x["mod"] >= since]
+        return list(notes)
+
+    def invoke(self, action, params):
+        handler = getattr(self, action, None)
+        if handler is None:
+            raise ValueError(f"unsupported action {action}")
+        return handler(**(params or {}))
+
+    def multi(self, actions):
+        results = []
+        for x in actions:
+            try:
+                results.append({"result": self.invoke(x["action"], x.get("params")), "error": None})
+            except Exception as e:
+                results.append({"result": None, "error": str(e)})
+        return results
+
+    def version(self):
+        return 6
+
+    def modelNames(self):
+        return list(self.models)
+
+    def modelNamesAndIds(self):
+        return dict(self.models)
+
+    def createModel(self, modelName, inOrderFields=(), **kwargs):
+        self.models[modelName] = self.new_id()
+        self.model_fields[modelName] = list(inOrderFields)
+        return {"id": self.models[modelName], "name": modelName}
+
+    def findModelsByName(self, modelNames):
+        return [
+            {
+                "id": self.models[x],
+                "name": x,
+                "sortf": 0,
+                "flds": [{"name": f, "ord": i} for i, f in enumerate(self.model_fields[x])],
+                "tmpls": [{"name": "Card 1", "ord": 0}],
+            }
+            for x in modelNames
+        ]
+
+    def importPackage(self, path):
+        # notes are matched by guid and mapped onto the model of the same id
+        with zipfile.ZipFile(path) as z, tempfile.TemporaryDirectory() as tmp:
+            z.extract("collection.anki2", tmp)
+            self.media.update(json.loads(z.read("media")).values())
+            con = sqlite3.connect(Path(tmp, "collection.anki2"))
+            models, decks = map(
+                json.loads, con.execute("select models, decks from col").fetchone()
+            )
+            names = {self.models[x["name"]]: x["name"] for x in models.values()}
+            by_guid = {x.get("guid"): x for x in self.notes.values()}
+            for guid, mid, tags, flds, did in con.execute(
+                "select guid, mid, tags, flds, did from notes join cards on cards.nid = notes.id"
+            ):
+                model = names[mid]
+                fields = dict(zip(self.model_fields[model], flds.split("\x1f")))
+                if guid in by_guid:
+                    by_guid[guid]["fields"].update(fields)
+                    continue
+                deck = decks[str(did)]["name"]
+                self.createDeck(deck)
+                nid = self.addNote(
+                    {"deckName": deck, "modelName": model, "fields": fields, "tags": tags.split()}
+                )
+                self.notes[nid]["guid"] = guid
+            con.close()
+        return True
+
+    def deckNames(self):
+        return list(self.decks)
+
+    def deckNamesAndIds(self):
+        return dict(self.decks)
+
+    def createDeck(self, deck):
+        for x in syak.deck_ancestors(deck):
+            self.decks.setdefault(x, self.new_id())
+        return self.decks[deck]
+
+    def deleteDecks(self, decks, cardsToo=True):
+        for deck in decks:
+            for name in [x for x in self.decks if x == deck or x.startswith(deck + "::")]:
+                del self.decks[name]
+        for nid in [x["id"] for x in self.notes.values() if self.cards[x["cards"][0]] not in self.decks]:
+            self.deleteNotes([nid])
+
+    def getDeckStats(self, decks):
+        stats = {}
+        for deck in decks:
+            if deck in self.decks:
+                total = sum(1 for x in self.cards.values() if x == deck or x.startswith(deck + "::"))
+                stats[str(self.decks[deck])] = {
+                    "deck_id": self.decks[deck],
+                    "name": deck,
+                    "new_count": total,
+                    "learn_count": 0,
+                    "review_count": 0,
+                    "total_in_deck": total,
+                }
+        return stats
+
+    def findNotes(self, query):
+        return [x["id"] for x in self.find(query)]
+
+    def findCards(self, query):
+        if query.startswith("nid:"):
+            return list(self.notes[int(query[4:])]["cards"])
+        return [c for x in self.find(query) for c in x["cards"]]
+
+    def notesInfo(self, notes):
+        return [
+            {
+                "noteId": x,
+                "modelName": self.notes[x]["model"],
+                "tags": [],
+                "fields": {
+                    k: {"value": v, "order": i}
+                    for i, (k, v) in enumerate(self.notes[x]["fields"].items())
+                },
+                "cards": self.notes[x]["cards"],
+                "mod": int(self.notes[x]["mod"]),
+            }
+            if x in self.notes
+            else {}
+            for x in notes
+        ]
+
+    def notesModTime(self, notes):
+        return [{"noteId": x, "mod": int(self.notes[x]["mod"])} for x in notes if x in self.notes]
+
+    def addNote(self, note):
+        if note["deckName"] not in self.decks:
+            raise ValueError(f"deck was not found: {note['deckName']}")
+        if note["modelName"] not in self.models:
+            raise ValueError(f"model was not found: {note['modelName']}")
+        nid, cid = self.new_id(), self.new_id()
+        self.notes[nid] = {
+            "id": nid,
+            "model": note["modelName"],
+            "fields": dict(note["fields"]),
+            "tags": list(note.get("tags", [])),
+            "cards": [cid],
+            "mod": time.time(),
+        }
+        self.cards[cid] = note["deckName"]
+        return nid
+
+    def addNotes(self, notes):
+        return [self.addNote(x) for x in notes]
+
+    def addTags(self, notes, tags):
+        for x in notes:
+            self.notes[x]["tags"].extend(tags.split())
+
+    def updateNoteFields(self, note):
+        if note["id"] not in self.notes:
+            raise ValueError("Note was not found")
+        self.notes[note["id"]]["fields"].update(note["fields"])
+        self.notes[note["id"]]["mod"] = time.time()
+
+    def changeDeck(self, cards, deck):
+        self.createDeck(deck)
+        for x in cards:
+            self.cards[x] = deck
+
+    def deleteNotes(self, notes):
+        for x in notes:
+            for card in self.notes.pop(x, {"cards": []})["cards"]:
+                del self.cards[card]
+
+    def storeMediaFile(self, filename, path=None, data=None, **kwargs):
+        if path is not None:
+            Path(path).read_bytes()
+        self.media.add(filename)
+        return filename
+
+    def getMediaFilesNames(self, pattern="*"):
+        return [x for x in self.media if fnmatch.fnmatch(x, pattern)]
+
+
+class FakeServer:
+    # one HTTP server for both AnkiConnect and the SiYuan API
+    def __init__(self, workspace: Workspace, anki: FakeAnki):
+        self.workspace = workspace
+        self.anki = anki
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                data = json.dumps(server.handle(self.path, body)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def handle(self, path, body):
+        req = json.loads(body) if body else {}
+        if path.startswith("/api/"):
+            try:
+                return {"code": 0, "msg": "", "data": self.siyuan(path, req)}
+            except sqlite3.Error as e:
+                return {"code": -1, "msg": str(e), "data": None}
+        try:
+            with self.lock:
+                return {"result": self.anki.invoke(req["action"], req.get("params")), "error": None}
+        except Exception as e:
+            return {"result": None, "error": str(e)}
+
+    def siyuan(self, path, req):
+        if path == "/api/notebook/lsNotebooks":
+            return {"notebooks": self.workspace.notebooks}
+        if path == "/api/system/version":
+            return "3.0.0"
+        if path == "/api/query/sql":
+            stmt = req["stmt"]
+            # like SiYuan, statements without a limit get the default search limit
+            if not re.search(r"\blimit\b", stmt, re.I):
+                stmt += " limit 64"
+            con = sqlite3.connect(self.workspace.path / "temp" / "siyuan.db")
+            con.row_factory = sqlite3.Row
+            try:
+                return [dict(x) for x in con.execute(stmt)]
+            finally:
+                con.close()
+        return None
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+PHASES = ["notebooks", "fetch", "anki_notes", "diff", "render", "package", "media", "invoke", "finish"]
+
+
+def measure(syak_, scenario, run_kwargs):
+    syak_.run(**run_kwargs)
+    metrics = syak_.metrics.to_dict()
+    # the time spent in every action sent to Anki
+    metrics["phases"]["invoke"] = sum(
+        v for k, v in metrics["phases"].items() if k.startswith("invoke:")
+    )
+    metrics["scenario"] = scenario
+    return metrics
+
+
+def bench(size, args):
+    with tempfile.TemporaryDirectory(prefix="syak-bench-") as tmp:
+        start = time.perf_counter()
+        workspace = Workspace(
+            Path(tmp, "siyuan"),
+            cards=size,
+            cards_per_parent=args.cards_per_parent,
+            depth=args.depth,
+            math=args.math,
+            tables=args.tables,
+            assets=args.assets,
+        )
+        print(f"generated {size} cards in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        server = FakeServer(workspace, FakeAnki())
+        syak_ = syak.SYAK(
+            workspace.path,
+            server.port,
+            server.port,
+            "SiYuanModel",
+            state_path=Path(tmp, "state", "state.db"),
+            workers=args.workers,
+            batch_size=args.batch_size,
+            bootstrap=args.bootstrap,
+            renderer=args.renderer,
+            siyuan_source=args.siyuan_source,
+        )
+        run_kwargs = {"incremental": args.incremental, "force": args.force}
+        results = [measure(syak_, "cold", run_kwargs)]
+        results.append(measure(syak_, "no-op", run_kwargs))
+        edited = workspace.edit(0.01)
+        results.append(measure(syak_, f"1% ({edited}) changed", run_kwargs))
+        server.close()
+        for x in results:
+            x["cards"] = size
+        return results
+
+
+def report(results):
+    header = ["cards", "scenario", "total"] + PHASES
+    header += ["requests", "sent KB", "recv KB", "peak MB"]
+    rows = [header]
+    for x in results:
+        rows.append(
+            [str(x["cards"]), x["scenario"], f"{x['seconds']:.3f}"]
+            + [f"{x['phases'].get(p, 0):.3f}" for p in PHASES]
+            + [
+                str(sum(r["count"] for r in x["requests"].values())),
+                f"{x['bytes_sent'] / 1024:.0f}",
+                f"{x['bytes_received'] / 1024:.0f}",
+                f"{(x['peak_rss'] or 0) / 2**20:.0f}",
+            ]
+        )
+    widths = [max(len(r[i]) for r in rows) for i in range(len(header))]
+    for r in rows:
+        print("  ".join(c.rjust(w) for c, w in zip(r, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SYAK with a synthetic workspace")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000])
+    parser.add_argument("--cards-per-parent", type=int, default=5)
+    parser.add_argument("--depth", help="nesting depth of card containers", type=int, default=1)
+    parser.add_argument("--math", help="share of cards with inline math", type=float, default=0.3)
+    parser.add_argument("--tables", help="share of parents with a table", type=float, default=0.1)
+    parser.add_argument("--assets", help="number of asset files", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--renderer", default="markdown2", choices=list(syak.RENDERERS))
+    parser.add_argument("--siyuan-source", default="db", choices=["db", "http"])
+    parser.add_argument("--batch-size", type=int, default=0)
+    parser.add_argument("--bootstrap", action="store_true")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--force", help="do not skip unchanged runs", action="store_true")
+    parser.add_argument("--json", help="also write the raw results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results.extend(bench(size, args))
+    report(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Check the markdown renderers against golden output and measure their speed.
+
+python bench/renderers.py
+
+Every bench/golden/*.md is SiYuan markdown as SYAK reads it from siyuan.db,
+next to it the html the default renderer (markdown2) makes of it. A renderer
+is safe to use when it gives the same html for every case, compared the way
+Anki shows it: whitespace between tags, markdown2's pygments markup and code
+classes (Anki has no styles for them) and a trailing ; in styles are ignored.
+Renderers that are not installed are skipped. Run with --update after a
+deliberate change of the default output.
+"""
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import syak  # noqa: E402
+
+GOLDEN = Path(__file__).resolve().parent / "golden"
+
+
+def normalize(html):
+    html = re.sub(r'<div class="codehilite">\s*(.*?)\s*</div>', r"\1", html, flags=re.S)
+    html = re.sub(
+        r"<pre>.*?</pre>", lambda m: re.sub(r"</?span[^>]*>", "", m.group()), html, flags=re.S
+    )
+    html = re.sub(r'<code class="[^"]*">', "<code>", html)
+    html = re.sub(r';"', '"', html)
+    html = re.sub(r"\s+</code></pre>", "</code></pre>", html)
+    # whitespace outside <pre> collapses when displayed
+    html = "".join(
+        x if x.startswith("<pre>") else re.sub(r"\n[ \t]+", "\n", x)
+        for x in re.split(r"(<pre>.*?</pre>)", html, flags=re.S)
+    )
+    html = re.sub(r">\s+<", "><", html)
+    return html.strip()
+
+
+def installed(renderer):
+    try:
+        syak.markdown_parser(renderer)
+    except ImportError:
+        return False
+    return True
+
+
+def check(renderer, cases):
+    # names of the cases whose html differs from the golden one
+    return [
+        name
+        for name, (markdown, golden) in cases.items()
+        if normalize(syak.render_markdown(markdown, renderer)) != normalize(golden)
+    ]
+
+
+def throughput(renderer, cases, seconds):
+    # blocks and markdown KB rendered per second, over the whole corpus again and again
+    markdowns = [x for x, _ in cases.values()]
+    size = sum(len(x) for x in markdowns)
+    n, s = 0, time.perf_counter()
+    while time.perf_counter() - s < seconds:
+        for x in markdowns:
+            syak.render_markdown(x, renderer)
+        n += 1
+    elapsed = time.perf_counter() - s
+    return n * len(markdowns) / elapsed, n * size / 1024 / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the markdown renderers")
+    parser.add_argument("--renderers", nargs="+", default=list(syak.RENDERERS))
+    parser.add_argument("--seconds", help="time spent timing each renderer", type=float, default=2.0)
+    parser.add_argument("--update", help="rewrite the golden html with markdown2", action="store_true")
+    args = parser.parse_args()
+
+    cases = {}
+    for path in sorted(GOLDEN.glob("*.md")):
+        markdown = path.read_text(encoding="utf-8")
+        html = path.with_suffix(".html")
+        if args.update:
+            html.write_text(syak.render_markdown(markdown), encoding="utf-8")
+        cases[path.stem] = (markdown, html.read_text(encoding="utf-8"))
+
+    rows = [["renderer", "cases", "blocks/s", "KB/s", "speedup", "differs"]]
+    base, failed = None, False
+    for renderer in args.renderers:
+        if not installed(renderer):
+            rows.append([renderer, "not installed", "", "", "", ""])
+            continue
+        differs = check(renderer, cases)
+        blocks, kb = throughput(renderer, cases, args.seconds)
+        base = base or blocks
+        rows.append(
+            [
+                renderer,
+                f"{len(cases) - len(differs)}/{len(cases)}",
+                f"{blocks:.0f}",
+                f"{kb:.0f}",
+                f"{blocks / base:.2f}x",
+                " ".join(differs),
+            ]
+        )
+        # the default renderer must keep giving the golden output
+        failed |= renderer == "markdown2" and bool(differs)
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    for r in rows:
+        print("  ".join(c.ljust(w) for c, w in zip(r, widths)).rstrip())
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,1551 @@
 import argparse
+import atexit
+import contextlib
+import cProfile
+import ctypes
+import ctypes.util
 import functools
+import hashlib
+import html
+import importlib.util
+import json
 import logging
+import math
+import os
 import re
+import select
 import sqlite3
+import struct
 import sys
+import threading
 import time
+import tracemalloc
+import zipfile
+from collections import deque
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Iterable
+from types import MappingProxyType
+from typing import Iterable, Mapping
 
-import markdown2 as mk2
-import pandas as pd
-import psutil
 import requests
-import schedule
 
-markdown = lambda x: mk2.markdown(
-    x, extras=["fenced-code-blocks", "code-friendly", "tables", "cuddled-lists"]
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+@functools.lru_cache(maxsize=None)
+def markdown_parser(renderer):
+    # renderers and schedule are imported where used, a cron run that finds
+    # nothing to sync never loads them; the other renderers are set up to follow
+    # the markdown2 extras: fenced code, tables, raw html passed through
+    if renderer == "markdown2":
+        import markdown2
+
+        # a Markdown instance keeps state while converting, one per call
+        return functools.partial(
+            markdown2.markdown,
+            extras=["fenced-code-blocks", "code-friendly", "tables", "cuddled-lists"],
+        )
+    if renderer == "mistune":
+        import mistune
+
+        return commonmark(
+            mistune.create_markdown(
+                renderer=mistune.HTMLRenderer(escape=False, allow_harmful_protocols=["siyuan:"]),
+                plugins=["table"],
+            )
+        )
+    if renderer == "markdown-it":
+        from markdown_it import MarkdownIt
+
+        return commonmark(MarkdownIt("commonmark", {"html": True}).enable("table").render)
+    raise ValueError(f"unknown renderer {renderer}")
+
+
+def commonmark(convert):
+    # commonmark parsers unescape \$ and \| in math and read __x__ as strong,
+    # markdown2 with code-friendly does neither: underscores outside code are
+    # escaped, and math is replaced by placeholders and put back the way
+    # markdown2 leaves it
+    def wrapper(x):
+        math = []
+
+        def protect(m):
+            x = m.group()
+            if x.lstrip().startswith("~~~"):
+                # not a fence to markdown2, plain text for the others as well
+                x = re.sub(r"^([ \t]*)~", r"\1\\~", x, flags=re.M)
+                return protect_regex.sub(protect, x)
+            if x.startswith(("`", "<", " ", "\t", "\\_")) or x.lstrip().startswith("`"):
+                return x
+            if x.startswith("_"):
+                return "\\_"
+            math.append(html.escape(markdown2_unescape_regex.sub(r"\1", x), quote=False))
+            return f"syakmath{len(math) - 1}x"
+
+        out = convert(protect_regex.sub(protect, x))
+        return placeholder_regex.sub(lambda m: math[int(m.group(1))], out)
+
+    return wrapper
+
+
+# renderer -> module it needs, markdown2 is the default and always installed
+RENDERERS = {"markdown2": "markdown2", "mistune": "mistune", "markdown-it": "markdown_it"}
+
+
+def markdown(x, renderer="markdown2"):
+    return markdown_parser(renderer)(x)
+
+
+# bump when render_markdown output changes, cached html of older versions is ignored
+RENDERER_VERSION = 3
+
+assets_regex = re.compile(r"(?<=\()assets\/(?=[\w-]*\d{14}-\S{7}\.[\w]+\))")
+ial_regex = re.compile(r"{:[^\}]*\"}")
+inline_eq_regex = re.compile(r"(?<![\\\&])\$([^\$]+)\$(?!\$)")
+eq_regex = re.compile(r"(?<![\\])\$\$([^\$]+)\$\$")
+# super block layout markers, {{{row / {{{col and the closing }}} on their own lines
+super_block_regex = re.compile(r"^[ \t]*(?:\{\{\{(?:row|col)|\}\}\})[ \t]*$", re.M)
+# fenced, ~~~ fenced, indented and inline code of any backtick count, html tags and
+# comments, display and inline math, escaped dollars and underscores, underscores
+protect_regex = re.compile(
+    r"^[ \t]*```.*?^[ \t]*```[ \t]*$|```.*?```"
+    r"|^[ \t]*~~~.*?^[ \t]*~~~[ \t]*$"
+    r"|(?:(?<=\n\n)|(?<=\A))(?:(?: {4}|\t)(?![ \t]*(?:[*+-]|\d+[.)])[ \t])[^\n]*(?:\n|\Z))+"
+    r"|(`+)(?!`)[^\n]*?(?<!`)\1(?!`)"
+    r"|<!--.*?-->|</?[A-Za-z][\w:-]*(?:\s[^<>]*)?/?>"
+    r"|(?<![\\])\$\$[^\$]+\$\$|(?<![\\\&])\$[^\$]+\$(?!\$)|\\\$|\\_|_",
+    re.S | re.M,
 )
+placeholder_regex = re.compile(r"syakmath(\d+)x")
+# backslash escapes markdown2 resolves, in math too
+markdown2_unescape_regex = re.compile(r"\\([\\`*_{}\[\]()>#+\-.!])")
+sy_link_regex = re.compile(r"(?<![\\])\(\((\d{14}-\S{7})\ [\'\"]([^\'\"]+)[\'\"]\)\)")
 
 logging.basicConfig(level=logging.WARNING)
 
+# SiYuan writes the index asynchronously, a block edited slightly before the last
+# synced one can show up late, so incremental queries look back a little
+WATERMARK_MARGIN = timedelta(seconds=60)
+SQLITE_MAX_VARS = 900
 
-def find_procs_by_name(name):
-    for p in psutil.process_iter(["name"]):
-        if re.search(name, p.info["name"], re.IGNORECASE):
-            return True
-    return False
+
+profile_lock = threading.Lock()
 
 
-def log(func):
+def timed(name):
+    # time a SYAK method as a phase of the current run
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.phase(name):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def measured(func):
+    # wraps a whole sync run: resets the metrics, optionally profiles it and
+    # writes the metrics out at the end
     @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        s = time.perf_counter()
-        res = func(*args, **kwargs)
-        print(f"{func.__name__} elapsed time:{time.perf_counter() - s}")
-        return res
+    def wrapper(self, *args, **kwargs):
+        if self.profile_dir:
+            # tracemalloc traces the whole process, profiled runs of several
+            # sources take turns
+            with profile_lock:
+                return measure(self, *args, **kwargs)
+        return measure(self, *args, **kwargs)
+
+    def measure(self, *args, **kwargs):
+        self.metrics.reset()
+        profile = None
+        if self.profile_dir:
+            profile = cProfile.Profile()
+            tracemalloc.start()
+            profile.enable()
+        try:
+            with self.metrics.phase("run"):
+                return func(self, *args, **kwargs)
+        except BaseException:
+            self.metrics.status = "failed"
+            raise
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.metrics.dump_profile(self.profile_dir, profile)
+            self.history.append(self.metrics.to_dict())
+            self.metrics.write(self.metrics_json, self.metrics_prom)
 
     return wrapper
 
 
+def render_markdown(x, renderer="markdown2"):
+    x = assets_regex.sub("", x)
+    x = ial_regex.sub(" ", x)
+    x = super_block_regex.sub("", x)
+    x = sy_link_regex.sub(lambda x: f"[{x.group(2)}](siyuan://blocks/{x.group(1)})", x)
+    x = markdown(x, renderer)
+    x = inline_eq_regex.sub(lambda x: x.group().strip("$").join(["\\(", "\\)"]), x)
+    x = eq_regex.sub(lambda x: x.group().strip("$").join(["\\[", "\\]"]), x)
+    return x
+
+
+def unique(seq):
+    # distinct items in order of first appearance
+    return list(dict.fromkeys(seq))
+
+
+def read_dicts(con, sql, params=()):
+    cur = con.execute(sql, params)
+    columns = [x[0] for x in cur.description]
+    return [dict(zip(columns, x)) for x in cur]
+
+
+def chunks(seq, size):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i : i + size]
+
+
+def deck_ancestors(deck):
+    parts = deck.split("::")
+    return ["::".join(parts[: i + 1]) for i in range(len(parts))]
+
+
+def default_state_path(SiYuan_PATH, Anki_Model):
+    key = f"{Path(SiYuan_PATH).resolve()}|{Anki_Model}".encode()
+    return Path.home() / ".syak" / f"state-{hashlib.sha1(key).hexdigest()[:12]}.db"
+
+
+class Watcher:
+    # blocks until SiYuan's database or data directory changed, with inotify on
+    # Linux and by polling mtimes elsewhere, bursts of writes are debounced
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    IN_Q_OVERFLOW = 0x4000
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, SiYuan_PATH, debounce=2.0, poll=5.0, max_delay=30.0):
+        self.temp = Path(SiYuan_PATH, "temp")
+        self.data = Path(SiYuan_PATH, "data")
+        self.debounce = debounce
+        self.poll = poll
+        self.max_delay = max_delay
+        self.watches = {}
+        self.fd = None
+        try:
+            self._init_inotify()
+        except OSError as e:
+            logging.warning(f"inotify unavailable, polling every {poll}s: {e}")
+            self.close()
+        self._last = self._snapshot()
+
+    def _init_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("not supported on this platform")
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self._add_watch(self.temp)
+        for root, _, _ in os.walk(self.data):
+            self._add_watch(Path(root))
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"{path}: {os.strerror(ctypes.get_errno())}")
+        self.watches[wd] = path
+
+    def close(self):
+        if self.fd is not None and self.fd >= 0:
+            os.close(self.fd)
+        self.fd = None
+        self.watches = {}
+
+    def _snapshot(self):
+        stats = []
+        for path in [
+            self.temp / "siyuan.db",
+            self.temp / "siyuan.db-wal",
+            self.data,
+            self.data / "assets",
+        ]:
+            try:
+                stat = path.stat()
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def _changed(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            snapshot = self._snapshot()
+            changed, self._last = snapshot != self._last, snapshot
+            return changed
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        changed = False
+        buf = os.read(self.fd, 64 << 10)
+        i = 0
+        while i < len(buf):
+            wd, mask, _, length = struct.unpack_from("iIII", buf, i)
+            name = buf[i + 16 : i + 16 + length].rstrip(b"\0").decode(errors="ignore")
+            i += 16 + length
+            path = self.watches.get(wd)
+            if mask & self.IN_Q_OVERFLOW:
+                changed = True
+            elif path == self.temp:
+                changed |= name.startswith("siyuan.db")
+            elif path is not None:
+                changed = True
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    try:
+                        for root, _, _ in os.walk(path / name):
+                            self._add_watch(Path(root))
+                    except OSError as e:
+                        logging.warning(e)
+        return changed
+
+    def wait(self):
+        while not self._changed(None if self.fd is not None else self.poll):
+            pass
+        # wait for the burst to settle, but not forever while somebody keeps typing
+        start = time.monotonic()
+        while time.monotonic() - start < self.max_delay and self._changed(self.debounce):
+            pass
+
+
+class SyncState:
+    # sidecar store of what has been synced to Anki, used by incremental runs,
+    # and a mirror of the SiYuan notes in Anki
+    note_columns = [
+        "note_id",
+        "id",
+        "note_parent_id",
+        "note_hpath",
+        "note_hash",
+        "note_updated",
+        "note_parent_updated",
+        "note_parent_hash",
+        "note_deck",
+        "cards",
+    ]
+    block_columns = [
+        "id",
+        "parent_id",
+        "hash",
+        "updated",
+        "parent_hash",
+        "parent_updated",
+        "deck",
+    ]
+
+    def __init__(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # run_async hands the connection to worker threads, one at a time
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.executescript(
+            """
+            create table if not exists meta (key text primary key, value text);
+            create table if not exists blocks (
+                id text primary key,
+                parent_id text,
+                hash text,
+                updated text,
+                parent_hash text,
+                parent_updated text,
+                deck text
+            );
+            create table if not exists notes (
+                note_id integer primary key,
+                id text,
+                note_parent_id text,
+                note_hpath text,
+                note_hash text,
+                note_updated text,
+                note_parent_updated text,
+                note_parent_hash text,
+                note_deck text,
+                cards text,
+                mod integer
+            );
+            create index if not exists notes_id on notes (id);
+            create table if not exists decks (name text primary key);
+            create table if not exists media (
+                filename text primary key,
+                size integer,
+                mtime real,
+                sha1 text
+            );
+            create table if not exists retries (
+                key text primary key,
+                act text,
+                action text,
+                id text,
+                state text,
+                attempts integer,
+                due real,
+                error text
+            );
+            """
+        )
+
+    def get_meta(self, key, default=None):
+        row = self.con.execute("select value from meta where key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.con.execute(
+            "insert or replace into meta (key, value) values (?, ?)", (key, value)
+        )
+
+    @property
+    def watermark(self):
+        return self.get_meta("watermark")
+
+    def blocks(self):
+        return read_dicts(self.con, "select * from blocks")
+
+    def save_blocks(self, blocks: list, replace=False, watermark=True):
+        with self.con:
+            if replace:
+                self.con.execute("delete from blocks")
+            rows = (tuple(str(x[c]) for c in self.block_columns) for x in blocks)
+            self.con.executemany(
+                f"insert or replace into blocks values ({','.join('?' * len(self.block_columns))})",
+                rows,
+            )
+            updated = [x[c] for x in blocks for c in ["updated", "parent_updated"] if x[c]]
+            if watermark and updated:
+                self.set_meta("watermark", max(max(updated), self.watermark or ""))
+
+    def advance_watermark(self):
+        # watermark from every synced block, for runs that saved blocks without one
+        updated = self.con.execute(
+            """select max(x) from (
+                select updated as x from blocks union all select parent_updated from blocks
+            ) where x glob '[0-9]*'"""
+        ).fetchone()[0]
+        if updated:
+            with self.con:
+                self.set_meta("watermark", max(updated, self.watermark or ""))
+
+    def drop_blocks(self, ids: Iterable):
+        with self.con:
+            self.con.executemany("delete from blocks where id = ?", ((i,) for i in ids))
+
+    def decks(self):
+        if self.get_meta("decks_seeded") is None:
+            # decks of notes synced before decks were tracked
+            with self.con:
+                self.save_decks(x for x, in self.con.execute("select distinct note_deck from notes"))
+                self.set_meta("decks_seeded", "1")
+        return {x for x, in self.con.execute("select name from decks")}
+
+    def save_decks(self, decks: Iterable):
+        with self.con:
+            self.con.executemany(
+                "insert or ignore into decks values (?)",
+                ((x,) for deck in decks if deck for x in deck_ancestors(deck)),
+            )
+
+    def drop_decks(self, decks: Iterable):
+        with self.con:
+            # deleting a deck in Anki deletes its children too
+            self.con.executemany(
+                "delete from decks where name = ? or substr(name, 1, length(?) + 2) = ? || '::'",
+                ((x, x, x) for x in decks),
+            )
+
+    def media(self):
+        return {
+            x[0]: x[1:]
+            for x in self.con.execute("select filename, size, mtime, sha1 from media")
+        }
+
+    def save_media(self, media: Iterable):
+        with self.con:
+            self.con.executemany("insert or replace into media values (?, ?, ?, ?)", media)
+
+    def retries(self):
+        # Anki actions that failed and wait for a retry, action is its json
+        return read_dicts(self.con, "select * from retries order by due")
+
+    def retries_due(self, now, max_attempts):
+        return self.con.execute(
+            "select count(*) from retries where due <= ? and attempts < ?", (now, max_attempts)
+        ).fetchone()[0]
+
+    def retry_states(self):
+        # block id -> the block as it was when its note action failed
+        return dict(self.con.execute("select id, state from retries where id is not null"))
+
+    def save_retries(self, retries: Iterable):
+        columns = ["key", "act", "action", "id", "state", "attempts", "due", "error"]
+        with self.con:
+            self.con.executemany(
+                f"insert or replace into retries values ({','.join('?' * len(columns))})",
+                (tuple(x[c] for c in columns) for x in retries),
+            )
+
+    def drop_retries(self, keys: Iterable):
+        with self.con:
+            self.con.executemany("delete from retries where key = ?", ((x,) for x in keys))
+
+    def drop_block_retries(self, ids: Iterable):
+        with self.con:
+            self.con.executemany("delete from retries where id = ?", ((x,) for x in ids))
+
+    def notes(self, ids=None):
+        sql = f"select {','.join(self.note_columns)} from notes"
+        if ids is None:
+            notes = read_dicts(self.con, sql)
+        else:
+            notes = []
+            for x in chunks(set(ids), SQLITE_MAX_VARS):
+                notes.extend(
+                    read_dicts(self.con, f"{sql} where id in ({','.join('?' * len(x))})", x)
+                )
+        for x in notes:
+            x["cards"] = json.loads(x["cards"])
+        return notes
+
+    def note_ids(self):
+        return {x for x, in self.con.execute("select note_id from notes")}
+
+    def note_block_ids(self):
+        return {x for x, in self.con.execute("select distinct id from notes")}
+
+    def note_mods(self):
+        return dict(self.con.execute("select note_id, mod from notes"))
+
+    @staticmethod
+    def notes_from_blocks(blocks: list):
+        fields = ["parent_id", "hpath", "hash", "updated", "parent_updated", "parent_hash", "deck"]
+        return [
+            dict(
+                {"note_id": x["note_id"], "id": x["id"], "cards": x["cards"]},
+                **{f"note_{field}": x[field] for field in fields},
+            )
+            for x in blocks
+        ]
+
+    def save_notes(self, notes: list, replace=False):
+        # mod is when the note was last known to match the mirror
+        mod = int(time.time())
+        rows = (
+            tuple(
+                int(x[c]) if c == "note_id" else json.dumps(x[c]) if c == "cards" else x[c]
+                for c in self.note_columns
+            )
+            + (mod,)
+            for x in notes
+        )
+        columns = self.note_columns + ["mod"]
+        with self.con:
+            if replace:
+                self.con.execute("delete from notes")
+            self.con.executemany(
+                f"insert or replace into notes ({','.join(columns)}) "
+                f"values ({','.join('?' * len(columns))})",
+                rows,
+            )
+
+    def drop_notes(self, note_ids: Iterable):
+        with self.con:
+            self.con.executemany(
+                "delete from notes where note_id = ?", ((int(i),) for i in note_ids)
+            )
+
+
+class RenderCache:
+    # persistent LRU cache of rendered html keyed by markdown, renderer and its version
+    def __init__(self, path, max_size=64 << 20):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.executescript(
+            """
+            create table if not exists cache (
+                key text primary key,
+                html text,
+                size integer,
+                used real
+            );
+            create index if not exists cache_used on cache (used);
+            """
+        )
+
+    @staticmethod
+    def key(x, renderer="markdown2"):
+        return hashlib.sha1(f"{RENDERER_VERSION}\0{renderer}\0{x}".encode()).hexdigest()
+
+    def get_many(self, keys: Iterable):
+        found = {}
+        for x in chunks(keys, SQLITE_MAX_VARS):
+            found.update(
+                self.con.execute(
+                    f"select key, html from cache where key in ({','.join('?' * len(x))})",
+                    x,
+                )
+            )
+        with self.con:
+            now = time.time()
+            self.con.executemany(
+                "update cache set used = ? where key = ?", ((now, k) for k in found)
+            )
+        return found
+
+    def put_many(self, items: dict):
+        now = time.time()
+        with self.con:
+            self.con.executemany(
+                "insert or replace into cache values (?, ?, ?, ?)",
+                ((k, v, len(v), now) for k, v in items.items()),
+            )
+        self.evict()
+
+    def evict(self):
+        total = self.con.execute("select coalesce(sum(size), 0) from cache").fetchone()[0]
+        if total <= self.max_size:
+            return
+        # drop least recently used entries down to 90% of the cap
+        drop, keys = total - self.max_size * 0.9, []
+        for key, size in self.con.execute("select key, size from cache order by used"):
+            if drop <= 0:
+                break
+            keys.append((key,))
+            drop -= size
+        with self.con:
+            self.con.executemany("delete from cache where key = ?", keys)
+
+
+class Renderer:
+    # below min_batch missing blocks the pool startup costs more than it saves; the
+    # pool is started on first use and kept, chunked and batched runs render often
+    def __init__(self, cache: RenderCache = None, workers=1, min_batch=200, renderer="markdown2"):
+        self.cache = cache
+        self.workers = workers
+        self.min_batch = min_batch
+        self.renderer = renderer
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+
+                self.pool = ProcessPoolExecutor(self.workers)
+                atexit.register(self.close)
+            return self.pool
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+                atexit.unregister(self.close)
+
+    def convert(self, markdowns: list):
+        render = functools.partial(render_markdown, renderer=self.renderer)
+        if self.workers <= 1 or len(markdowns) < self.min_batch:
+            return list(map(render, markdowns))
+        chunksize = max(1, len(markdowns) // (self.workers * 4))
+        return list(self.get_pool().map(render, markdowns, chunksize=chunksize))
+
+    def render_many(self, markdowns: Iterable):
+        markdowns = list(markdowns)
+        keys = [RenderCache.key(x, self.renderer) for x in markdowns]
+        html = self.cache.get_many(set(keys)) if self.cache else {}
+        missing = {k: x for k, x in zip(keys, markdowns) if k not in html}
+        rendered = dict(zip(missing, self.convert(list(missing.values()))))
+        if self.cache and rendered:
+            self.cache.put_many(rendered)
+        html.update(rendered)
+        return [html[k] for k in keys]
+
+
+@dataclass
+class SyncDiff:
+    # card blocks and notes are plain dicts, notes to update carry the fields of
+    # both the note and its block
+    blocks: list
+    create: list
+    update: list
+    move: list
+    delete: list
+    # ids of removed cards on incremental runs, None on full runs
+    deleted: list
+    new_decks: list
+
+
+@dataclass(frozen=True)
+class SyncPlan:
+    # what one run sends to Anki, built from a SyncDiff and dropped once executed,
+    # nothing of it outlives the run
+    diff: SyncDiff
+    # action name -> AnkiConnect actions, read only
+    actions: Mapping
+    # files sent by storeMediaFile, as returned by media_from_blocks
+    media: tuple
+    summary: tuple
+    # files bundled into the package of importPackage
+    packaged: tuple = ()
+
+
+class SiYuanDB:
+    # read-only access to SiYuan's index, card blocks are the blocks referencing a
+    # card document, fetched together with the container they sit in in one query
+    container_types = ("l", "i", "b", "s")
+
+    def __init__(self, path, parent_depth=1, container_types=None, include=None, exclude=None):
+        # the back of a card is the outermost container reached walking up at most
+        # parent_depth levels through blocks of container_types; include and exclude
+        # are notebook (box) ids whose cards are the only ones synced or never synced
+        self.parent_depth = parent_depth
+        if container_types is not None:
+            self.container_types = tuple(container_types)
+        uri = Path(path).resolve().as_uri() + "?mode=ro"
+        self.con = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.con.executescript(
+            """
+            create temp table card_docs (id text primary key);
+            create temp table ids (id text primary key);
+            create temp table include_boxes (box text primary key);
+            create temp table exclude_boxes (box text primary key);
+            """
+        )
+        self.include = include
+        self.exclude = exclude
+        with self.con:
+            for table, boxes in [("include_boxes", include), ("exclude_boxes", exclude)]:
+                self.con.executemany(
+                    f"insert or ignore into temp.{table} values (?)", ((x,) for x in boxes or [])
+                )
+        self._card_docs = None
+
+    def card_docs(self, refresh=False):
+        # card documents are resolved once per run, refs are then looked up by id
+        if self._card_docs is None or refresh:
+            self._card_docs = [
+                x
+                for x, in self.con.execute(
+                    "select id from blocks where type = 'd' and content like '%card%' order by id"
+                )
+            ]
+            with self.con:
+                self.con.execute("delete from temp.card_docs")
+                self.con.executemany(
+                    "insert or ignore into temp.card_docs values (?)",
+                    ((x,) for x in self._card_docs),
+                )
+        return self._card_docs
+
+    def card_ids_sql(self):
+        # notebooks are filtered here, blocks of other notebooks are never read
+        self.card_docs()
+        sql = "select block_id from refs where def_block_id in (select id from temp.card_docs)"
+        if self.include is not None:
+            sql += " and box in (select box from temp.include_boxes)"
+        if self.exclude:
+            sql += " and box not in (select box from temp.exclude_boxes)"
+        return sql
+
+    def parents_key(self):
+        return json.dumps([self.parent_depth, list(self.container_types)])
+
+    def chain_sql(self, selected):
+        # one recursive query for the ancestors of every card instead of one per
+        # level, a row per card and container on its way up, the hash and updated
+        # of a row cover every container below it so an edit anywhere on the chain
+        # reaches the note
+        types = ",".join("?" * len(self.container_types))
+        sql = f"""with recursive card_ids (id) as ({selected}),
+            chain (id, parent_id, next_id, depth, hash, updated) as (
+                select b.id, p.id, p.parent_id, 1, p.hash, p.updated
+                from blocks b join blocks p on p.id = b.parent_id and p.type in ({types})
+                where b.id in (select id from card_ids)
+                union all
+                select c.id, p.id, p.parent_id, c.depth + 1,
+                    c.hash || p.hash, max(c.updated, p.updated)
+                from chain c join blocks p on p.id = c.next_id and p.type in ({types})
+                where c.depth < ?
+            )"""
+        return sql, self.container_types * 2 + (self.parent_depth,)
+
+    def data_version(self):
+        return self.con.execute("pragma data_version").fetchone()[0]
+
+    def read(self, sql, params=()):
+        return read_dicts(self.con, sql, params)
+
+    def card_blocks(self, ids: Iterable = None):
+        # card blocks joined with their container parent, all of them or only ids
+        if ids is None:
+            selected = self.card_ids_sql()
+        else:
+            with self.con:
+                self.con.execute("delete from temp.ids")
+                self.con.executemany(
+                    "insert or ignore into temp.ids values (?)", ((x,) for x in ids)
+                )
+            selected = "select id from temp.ids"
+        chain, params = self.chain_sql(selected)
+        # the topmost container is the back and stands in for the direct parent,
+        # the later parent_id column wins in read_dicts
+        blocks = self.read(
+            f"""{chain},
+                parents (id, parent_id, hash, updated) as (
+                    select id, parent_id, hash, updated
+                    from (select *, max(depth) from chain group by id)
+                )
+                select b.*,
+                    coalesce(c.parent_id, b.parent_id) as parent_id,
+                    coalesce(p.markdown, '') as parent_markdown,
+                    coalesce(c.updated, '') as parent_updated,
+                    coalesce(c.hash, '') as parent_hash
+                from blocks b
+                left join parents c on c.id = b.id
+                left join blocks p on p.id = c.parent_id
+                where b.id in (select id from card_ids)""",
+            params,
+        )
+        return blocks
+
+    def card_index(self):
+        return self.read(
+            f"select id, parent_id, box, hpath from blocks where id in ({self.card_ids_sql()})"
+        )
+
+    def changed_card_ids(self, since):
+        # card blocks updated since, and card blocks with a container on their
+        # chain that was
+        chain, params = self.chain_sql(self.card_ids_sql())
+        changed = self.con.execute(
+            f"""{chain}
+                select id from blocks where id in (select id from card_ids) and updated >= ?
+                union select id from chain where updated >= ?""",
+            params + (since, since),
+        )
+        return {x for x, in changed}
+
+    def cards_fingerprint(self):
+        chain, params = self.chain_sql(self.card_ids_sql())
+        return self.con.execute(
+            f"""{chain}
+                select count(*), max(b.updated), max(p.updated),
+                    (select max(updated) from chain),
+                    group_concat(distinct b.box || b.hpath)
+                from blocks b left join blocks p on p.id = b.parent_id
+                where b.id in (select id from card_ids)""",
+            params,
+        ).fetchone()
+
+
+class Metrics:
+    # timings and counters of one sync run, phases may run in threads on async runs,
+    # source names the workspace of the run when one process syncs several
+    def __init__(self, source=None):
+        self.lock = threading.Lock()
+        self.source = source
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.status = "ok"
+        self.phases = {}
+        self.counts = {}
+        self.requests = {}
+        self.summary = []
+        self.traced_peak = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        s = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - s
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def request(self, name, seconds, sent, received):
+        with self.lock:
+            x = self.requests.setdefault(
+                name, {"count": 0, "seconds": 0, "sent": 0, "received": 0}
+            )
+            x["count"] += 1
+            x["seconds"] += seconds
+            x["sent"] += sent
+            x["received"] += received
+
+    @staticmethod
+    def peak_rss():
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak << 10
+
+    def to_dict(self):
+        source = {} if self.source is None else {"source": self.source}
+        return {
+            **source,
+            "time": round(self.started, 3),
+            "status": self.status,
+            "seconds": round(self.phases.get("run", 0), 6),
+            "phases": {k: round(v, 6) for k, v in self.phases.items()},
+            "counts": dict(self.counts),
+            "requests": {
+                k: dict(v, seconds=round(v["seconds"], 6)) for k, v in self.requests.items()
+            },
+            "bytes_sent": sum(x["sent"] for x in self.requests.values()),
+            "bytes_received": sum(x["received"] for x in self.requests.values()),
+            "peak_rss": self.peak_rss(),
+            "traced_peak": self.traced_peak,
+            "summary": list(self.summary),
+        }
+
+    def prometheus(self):
+        m = self.to_dict()
+        source = {} if self.source is None else {"source": self.source}
+        lines = []
+
+        def gauge(name, value, help, labels=None):
+            if not any(x.startswith(f"# TYPE {name} ") for x in lines):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} gauge")
+            labels = dict(source, **(labels or {}))
+            label = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+
+        gauge("syak_last_run_timestamp_seconds", m["time"], "start of the last sync run")
+        for status in ["ok", "unchanged", "offline", "failed"]:
+            gauge(
+                "syak_last_run_status",
+                int(m["status"] == status),
+                "status of the last sync run",
+                {"status": status},
+            )
+        gauge("syak_run_seconds", m["seconds"], "duration of the last sync run")
+        for k, v in m["phases"].items():
+            gauge("syak_phase_seconds", v, "time spent in each phase", {"phase": k})
+        for k, v in m["counts"].items():
+            gauge("syak_count", v, "notes, decks and media handled", {"name": k})
+        # the samples of one metric family have to stay together
+        for k, v in m["requests"].items():
+            gauge("syak_requests", v["count"], "HTTP requests sent", {"action": k})
+        for k, v in m["requests"].items():
+            gauge("syak_request_seconds", v["seconds"], "time waiting for HTTP requests", {"action": k})
+        gauge("syak_http_bytes", m["bytes_sent"], "HTTP payload bytes", {"direction": "sent"})
+        gauge("syak_http_bytes", m["bytes_received"], "HTTP payload bytes", {"direction": "received"})
+        if m["peak_rss"] is not None:
+            gauge("syak_peak_rss_bytes", m["peak_rss"], "peak resident memory of the process")
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, prom_path=None):
+        if json_path == "-":
+            print(json.dumps(self.to_dict()), flush=True)
+        elif json_path:
+            with open(json_path, "a") as f:
+                f.write(json.dumps(self.to_dict()) + "\n")
+        if prom_path:
+            # the node exporter may read at any time, never let it see half a file
+            tmp = f"{prom_path}.{os.getpid()}.tmp"
+            Path(tmp).write_text(self.prometheus())
+            os.replace(tmp, prom_path)
+
+    def dump_profile(self, path, profile: cProfile.Profile):
+        # cProfile only sees the calling thread, async runs profile the event loop
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        name = time.strftime("syak-%Y%m%d%H%M%S", time.localtime(self.started))
+        profile.dump_stats(path / f"{name}.prof")
+        snapshot = tracemalloc.take_snapshot()
+        self.traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stats = snapshot.statistics("lineno")[:50]
+        (path / f"{name}-memory.txt").write_text(
+            f"peak traced memory: {self.traced_peak}\n" + "\n".join(map(str, stats)) + "\n"
+        )
+
+
+class SiYuanError(Exception):
+    pass
+
+
+class SiYuanHTTP:
+    # SiYuan's index read through /api/query/sql instead of opening siyuan.db, with
+    # the same methods as SiYuanDB; SiYuan caps results without a LIMIT, so long
+    # queries are paged, and markdown is only fetched again for blocks whose hash
+    # or updated changed since it was last fetched
+    container_types = SiYuanDB.container_types
+    meta_columns = ["id", "parent_id", "root_id", "box", "hpath", "type", "hash", "updated"]
+    parents_key = SiYuanDB.parents_key
+
+    def __init__(
+        self,
+        url,
+        parent_depth=1,
+        container_types=None,
+        include=None,
+        exclude=None,
+        page_size=1000,
+        metrics: Metrics = None,
+    ):
+        self.url = url + "/api/query/sql"
+        self.parent_depth = parent_depth
+        if container_types is not None:
+            self.container_types = tuple(container_types)
+        self.include = include
+        self.exclude = exclude
+        self.page_size = page_size
+        self.metrics = metrics or Metrics()
+        self.session = requests.Session()
+        # block id -> (hash, updated, markdown) as last fetched
+        self.markdowns = {}
+        self._card_docs = None
+
+    @staticmethod
+    def quote(values: Iterable):
+        return ",".join("'" + str(x).replace("'", "''") + "'" for x in values)
+
+    def request(self, stmt):
+        s = time.perf_counter()
+        resp = self.session.post(self.url, json={"stmt": stmt})
+        self.metrics.request(
+            "/api/query/sql",
+            time.perf_counter() - s,
+            len(resp.request.body or b""),
+            len(resp.content),
+        )
+        resp.raise_for_status()
+        resp = resp.json()
+        if resp.get("code") != 0:
+            raise SiYuanError(f"query: {resp.get('msg')}")
+        return resp["data"] or []
+
+    def read(self, sql, order="id"):
+        # page by page until a short page, ordered so pages do not overlap
+        rows = []
+        while True:
+            page = self.request(
+                f"{sql} order by {order} limit {self.page_size} offset {len(rows)}"
+            )
+            rows.extend(page)
+            if len(page) < self.page_size:
+                return rows
+
+    def read_ids(self, columns, ids: Iterable):
+        # rows of blocks by id, a bounded number of ids per query
+        rows = []
+        for x in chunks(unique(ids), 500):
+            rows.extend(
+                self.read(f"select {','.join(columns)} from blocks where id in ({self.quote(x)})")
+            )
+        return rows
+
+    def card_docs(self, refresh=False):
+        if self._card_docs is None or refresh:
+            self._card_docs = [
+                x["id"]
+                for x in self.read("select id from blocks where type = 'd' and content like '%card%'")
+            ]
+        return self._card_docs
+
+    def card_ids_sql(self):
+        sql = f"select block_id from refs where def_block_id in ({self.quote(self.card_docs())})"
+        if self.include is not None:
+            sql += f" and box in ({self.quote(self.include)})"
+        if self.exclude:
+            sql += f" and box not in ({self.quote(self.exclude)})"
+        return sql
+
+    def data_version(self):
+        # nothing tells a commit over HTTP, the cards fingerprint does
+        return None
+
+    def card_index(self):
+        return self.read(
+            f"select id, parent_id, box, hpath from blocks where id in ({self.card_ids_sql()})"
+        )
+
+    def chains(self, blocks):
+        # card id -> (outermost container, chain hash, chain updated) like
+        # SiYuanDB.chain_sql, walked up one level at a time for all cards at once
+        chains, meta = {}, {}
+        current = {x["id"]: x["parent_id"] for x in blocks}
+        for _ in range(self.parent_depth):
+            wanted = [x for x in current.values() if x and x not in meta]
+            meta.update((x["id"], x) for x in self.read_ids(self.meta_columns, wanted))
+            parents = {}
+            for id, parent_id in current.items():
+                parent = meta.get(parent_id)
+                if parent is None or parent["type"] not in self.container_types:
+                    continue
+                _, hash, updated = chains.get(id, (None, "", ""))
+                chains[id] = (parent_id, hash + parent["hash"], max(updated, parent["updated"]))
+                parents[id] = parent["parent_id"]
+            current = parents
+        return chains, meta
+
+    def fetch_markdown(self, rows: Iterable):
+        # markdown of rows, from the cache when hash and updated are the same
+        rows = list(rows)
+        stale = [
+            x["id"]
+            for x in rows
+            if self.markdowns.get(x["id"], (None, None))[:2] != (x["hash"], x["updated"])
+        ]
+        fetched = {x["id"]: x["markdown"] for x in self.read_ids(["id", "markdown"], stale)}
+        for x in rows:
+            if x["id"] in fetched:
+                self.markdowns[x["id"]] = (x["hash"], x["updated"], fetched[x["id"]])
+        return {x["id"]: self.markdowns[x["id"]][2] for x in rows if x["id"] in self.markdowns}
+
+    def card_blocks(self, ids: Iterable = None):
+        if ids is None:
+            blocks = self.read(
+                f"select {','.join(self.meta_columns)} from blocks "
+                f"where id in ({self.card_ids_sql()})"
+            )
+        else:
+            blocks = self.read_ids(self.meta_columns, ids)
+        chains, meta = self.chains(blocks)
+        rows = blocks + [meta[x[0]] for x in chains.values()]
+        if ids is None:
+            # a full read sees every block still needed, forget the others
+            current = {x["id"] for x in rows}
+            self.markdowns = {k: v for k, v in self.markdowns.items() if k in current}
+        markdown = self.fetch_markdown(rows)
+        for x in blocks:
+            parent_id, hash, updated = chains.get(x["id"], (None, "", ""))
+            x["markdown"] = markdown.get(x["id"], "")
+            x["parent_markdown"] = markdown.get(parent_id, "") if parent_id else ""
+            x["parent_id"] = parent_id or x["parent_id"]
+            x["parent_hash"] = hash
+            x["parent_updated"] = updated
+        return blocks
+
+    def changed_card_ids(self, since):
+        blocks = self.read(
+            f"select id, parent_id, updated from blocks where id in ({self.card_ids_sql()})"
+        )
+        chains, _ = self.chains(blocks)
+        return {
+            x["id"]
+            for x in blocks
+            if x["updated"] >= since or chains.get(x["id"], ("", "", ""))[2] >= since
+        }
+
+    def cards_fingerprint(self):
+        # card blocks and their parents as in SiYuanDB, with parent_depth > 1 the
+        # ancestors further up are joined level by level instead of a recursive query
+        levels = range(2, self.parent_depth + 1)
+        joins = "".join(f" left join blocks p{i} on p{i}.id = p{i - 1}.parent_id" for i in levels)
+        ancestors = "".join(f", max(p{i}.updated) as a{i}" for i in levels)
+        row = self.request(
+            f"""select count(*) as n, max(b.updated) as updated, max(p1.updated) as parent_updated,
+                    group_concat(distinct b.box || b.hpath) as decks{ancestors}
+                from blocks b left join blocks p1 on p1.id = b.parent_id{joins}
+                where b.id in ({self.card_ids_sql()})"""
+        )[0]
+        return [row["n"], row["updated"], row["parent_updated"], row["decks"]] + [
+            row[f"a{i}"] for i in levels
+        ]
+
+
+class AnkiConnectError(Exception):
+    pass
+
+
+class AnkiConnect:
+    # keep-alive AnkiConnect client, big multi calls are split into chunks so one
+    # huge request does not block Anki's main thread; clients sharing a lock send
+    # one request at a time, so several sources write to one Anki in turn
+    def __init__(self, url, chunk_size=200, pause=0.0, metrics: Metrics = None, lock=None):
+        self.url = url
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.metrics = metrics or Metrics()
+        self.session = requests.Session()
+        self.lock = lock or threading.Lock()
+
+    def request(self, action, params=None, name=None):
+        # name is what the request is counted as in the metrics, defaults to action
+        payload = {"action": action, "version": 6}
+        if params:
+            payload["params"] = params
+        with self.lock:
+            s = time.perf_counter()
+            resp = self.session.post(self.url, json=payload)
+        self.metrics.request(
+            name or action,
+            time.perf_counter() - s,
+            len(resp.request.body or b""),
+            len(resp.content),
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    @staticmethod
+    def result(action, resp):
+        if resp.get("error"):
+            raise AnkiConnectError(f"{action}: {resp['error']}")
+        return resp["result"]
+
+    def invoke(self, action, **params):
+        return self.result(action, self.request(action, params))
+
+    @staticmethod
+    def action(action, **params):
+        return {"action": action, "version": 6, "params": params}
+
+    def stream(self, actions: list):
+        # yields the results of each chunk, a chunk is only sent after the previous
+        # one was answered, with an optional pause to let Anki catch up
+        for i, chunk in enumerate(chunks(actions, self.chunk_size)):
+            if i and self.pause:
+                time.sleep(self.pause)
+            resp = self.request("multi", {"actions": chunk}, f"multi:{chunk[0]['action']}")
+            yield list(
+                map(
+                    lambda x: x
+                    if isinstance(x, dict) and set(x) == {"result", "error"}
+                    else {"result": x, "error": None},
+                    self.result("multi", resp),
+                )
+            )
+
+    def multi(self, actions: list):
+        results = []
+        for x in self.stream(actions):
+            results.extend(x)
+        return results
+
+
+class HealthProbe:
+    # liveness of Anki and SiYuan from their version endpoints, an answer is
+    # trusted for ttl seconds, a service that is down is probed less and less
+    # often, up to max_backoff seconds apart; Anki is probed under the lock its
+    # writers share and one that accepts but answers late is busy, not down
+    def __init__(
+        self,
+        anki_url,
+        siyuan_url,
+        timeout=1.0,
+        ttl=10.0,
+        backoff=5.0,
+        max_backoff=300.0,
+        metrics: Metrics = None,
+        anki_lock=None,
+    ):
+        self.services = {
+            "Anki": (anki_url, {"action": "version", "version": 6}),
+            "SiYuan": (siyuan_url + "/api/system/version", None),
+        }
+        self.timeout = timeout
+        self.ttl = ttl
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.metrics = metrics or Metrics()
+        self.session = requests.Session()
+        self.locks = {"Anki": anki_lock or contextlib.nullcontext()}
+        self.status = {x: {"alive": None, "checked": 0.0, "failures": 0} for x in self.services}
+
+    def probe(self, name):
+        url, payload = self.services[name]
+        try:
+            with self.locks.get(name, contextlib.nullcontext()):
+                s = time.perf_counter()
+                resp = self.session.post(url, json=payload, timeout=self.timeout)
+            self.metrics.request(
+                f"probe:{name}",
+                time.perf_counter() - s,
+                len(resp.request.body or b""),
+                len(resp.content),
+            )
+            resp.raise_for_status()
+        except requests.ReadTimeout:
+            logging.debug(f"{name} probe: connected but busy")
+            return True
+        except requests.RequestException as e:
+            logging.debug(f"{name} probe: {e}")
+            return False
+        return True
+
+    def alive(self, name):
+        status = self.status[name]
+        now = time.monotonic()
+        if status["alive"]:
+            wait = self.ttl
+        else:
+            wait = min(self.backoff * 2 ** (status["failures"] - 1), self.max_backoff)
+        if status["alive"] is not None and now - status["checked"] < wait:
+            return status["alive"]
+
+        alive = self.probe(name)
+        # only log changes, a service that stays down is not reported every run
+        if alive and status["failures"]:
+            logging.warning(f"{name} is running again.")
+        elif not alive and not status["failures"]:
+            logging.warning(f"{name} not running!")
+        status.update(alive=alive, checked=now, failures=0 if alive else status["failures"] + 1)
+        return alive
+
+    def __call__(self):
+        return self.alive("Anki") and self.alive("SiYuan")
+
+
+class AnkiPackage:
+    # writes notes of one model into an .apkg (legacy collection.anki2 schema) that
+    # Anki imports in one go, instead of adding the notes one by one over AnkiConnect
+    schema = """
+        create table col (
+            id integer primary key, crt integer not null, mod integer not null,
+            scm integer not null, ver integer not null, dty integer not null,
+            usn integer not null, ls integer not null, conf text not null,
+            models text not null, decks text not null, dconf text not null,
+            tags text not null
+        );
+        create table notes (
+            id integer primary key, guid text not null, mid integer not null,
+            mod integer not null, usn integer not null, tags text not null,
+            flds text not null, sfld integer not null, csum integer not null,
+            flags integer not null, data text not null
+        );
+        create table cards (
+            id integer primary key, nid integer not null, did integer not null,
+            ord integer not null, mod integer not null, usn integer not null,
+            type integer not null, queue integer not null, due integer not null,
+            ivl integer not null, factor integer not null, reps integer not null,
+            lapses integer not null, left integer not null, odue integer not null,
+            odid integer not null, flags integer not null, data text not null
+        );
+        create table revlog (
+            id integer primary key, cid integer not null, usn integer not null,
+            ease integer not null, ivl integer not null, lastIvl integer not null,
+            factor integer not null, time integer not null, type integer not null
+        );
+        create table graves (
+            usn integer not null, oid integer not null, type integer not null
+        );
+        """
+    tag_regex = re.compile(r"<[^>]*>")
+
+    def __init__(self, model: dict, tags: Iterable = ()):
+        # model is the notetype as Anki has it (findModelsByName), so the import
+        # maps the notes onto the existing model instead of creating a copy
+        self.model = model
+        tags = " ".join(tags)
+        self.tags = f" {tags} " if tags else ""
+        self.field_names = [x["name"] for x in sorted(model["flds"], key=lambda x: x["ord"])]
+        self.notes = []
+        self.decks = {}
+
+    @staticmethod
+    def guid(key):
+        # stable per block, importing a note again updates it instead of duplicating it
+        return hashlib.sha1(f"syak:{key}".encode()).hexdigest()[:16]
+
+    def deck_id(self, deck):
+        # ids are local to the package, Anki maps decks by name
+        return self.decks.setdefault(deck, len(self.decks) + 2)
+
+    def add_note(self, key, fields: dict, deck):
+        fields = ["" if fields[x] is None else str(fields[x]) for x in self.field_names]
+        self.notes.append((self.guid(key), fields, self.deck_id(deck)))
+
+    def deck_json(self, did, name, mod):
+        return {
+            "id": did,
+            "name": name,
+            "mod": mod,
+            "usn": -1,
+            "lrnToday": [0, 0],
+            "revToday": [0, 0],
+            "newToday": [0, 0],
+            "timeToday": [0, 0],
+            "collapsed": False,
+            "browserCollapsed": False,
+            "desc": "",
+            "dyn": 0,
+            "conf": 1,
+            "extendNew": 0,
+            "extendRev": 0,
+        }
+
+    def write_collection(self, path, mod):
+        decks = {"1": self.deck_json(1, "Default", mod)}
+        for name, did in self.decks.items():
+            decks[str(did)] = self.deck_json(did, name, mod)
+        dconf = {
+            "1": {
+                "id": 1,
+                "name": "Default",
+                "mod": 0,
+                "usn": 0,
+                "maxTaken": 60,
+                "autoplay": True,
+                "timer": 0,
+                "replayq": True,
+                "dyn": False,
+                "new": {
+                    "delays": [1, 10],
+                    "ints": [1, 4, 0],
+                    "initialFactor": 2500,
+                    "order": 1,
+                    "perDay": 20,
+                },
+                "lapse": {
+                    "delays": [10],
+                    "mult": 0,
+                    "minInt": 1,
+                    "leechFails": 8,
+                    "leechAction": 1,
+                },
+                "rev": {"perDay": 200, "ease4": 1.3, "maxIvl": 36500, "hardFactor": 1.2},
+            }
+        }
+        con = sqlite3.connect(path)
+        try:
+            con.executescript(self.schema)
+            con.execute(
+                "insert into col values (1, ?, ?, ?, 11, 0, 0, 0, ?, ?, ?, ?, '{}')",
+                (
+                    mod,
+                    mod * 1000,
+                    mod * 1000,
+                    json.dumps({"nextPos": len(self.notes) + 1, "curModel": self.model["id"]}),
+                    json.dumps({str(self.model["id"]): self.model}),
+                    json.dumps(decks),
+                    json.dumps(dconf),
+                ),
+            )
+            # note and card ids only have to be unique here, Anki picks new ones on clashes
+            base = mod * 1000
+            con.executemany(
+                "insert into notes values (?, ?, ?, ?, -1, ?, ?, ?, ?, 0, '')",
+                (
+                    (base + i, guid, self.model["id"], mod, self.tags, "\x1f".join(fields))
+                    + self.sort_field(fields)
+                    for i, (guid, fields, _) in enumerate(self.notes)
+                ),
+            )
+            con.executemany(
+                "insert into cards values "
+                "(?, ?, ?, 0, ?, -1, 0, 0, ?, 0, 0, 0, 0, 0, 0, 0, 0, '')",
+                (
+                    (base + i, base + i, did, mod, i + 1)
+                    for i, (_, _, did) in enumerate(self.notes)
+                ),
+            )
+            con.commit()
+        finally:
+            con.close()
+
+    def sort_field(self, fields):
+        # sfld and csum are what Anki sorts and checks duplicates on
+        x = self.tag_regex.sub("", fields[self.model.get("sortf", 0)]).strip()
+        return x, int(hashlib.sha1(x.encode()).hexdigest()[:8], 16)
+
+    def write(self, path, media: Iterable = ()):
+        # media are paths of files to bundle, stored in the zip as 0, 1, ... with a
+        # json index of their names
+        path = Path(path)
+        collection = path.with_suffix(".anki2")
+        collection.unlink(missing_ok=True)
+        self.write_collection(collection, int(time.time()))
+        media = list(media)
+        try:
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+                z.write(collection, "collection.anki2")
+                for i, x in enumerate(media):
+                    z.write(x, str(i), compress_type=zipfile.ZIP_STORED)
+                names = {str(i): Path(x).name for i, x in enumerate(media)}
+                z.writestr("media", json.dumps(names))
+        finally:
+            collection.unlink(missing_ok=True)
+        return path
+
+
 class SYAK:
-    def __init__(self, SiYuan_PATH, SiYuan_Port, Anki_Port, Anki_Model):
+    # a failed Anki action is retried after retry_backoff seconds, doubled on
+    # every failure up to retry_max_backoff, until max_retries attempts failed
+    retry_backoff = 60.0
+    retry_max_backoff = 6 * 3600.0
+
+    def __init__(
+        self,
+        SiYuan_PATH,
+        SiYuan_Port,
+        Anki_Port,
+        Anki_Model,
+        state_path=None,
+        render_cache_size=64,
+        workers=1,
+        anki_chunk_size=200,
+        anki_pause=0.0,
+        metrics_json=None,
+        metrics_prom=None,
+        profile_dir=None,
+        history=20,
+        batch_size=0,
+        bootstrap=False,
+        parent_depth=1,
+        parent_types=None,
+        include=None,
+        exclude=None,
+        notebook_decks=None,
+        source=None,
+        anki_lock=None,
+        renderer="markdown2",
+        siyuan_source="db",
+        max_retries=5,
+    ):
         self._SiYuan_PATH = SiYuan_PATH
         self._SiYuan_DB_PATH = Path(SiYuan_PATH, "temp", "siyuan.db")
         self._SiYuan_ASSETS_PATH = Path(SiYuan_PATH, "data", "assets")
         self._SiYuan_URL = f"http://localhost:{SiYuan_Port}"
         self._Anki_URL = f"http://localhost:{Anki_Port}"
+        self.metrics = Metrics(source)
+        self.metrics_json = metrics_json
+        self.metrics_prom = metrics_prom
+        self.profile_dir = profile_dir
+        self.batch_size = batch_size
+        self.bootstrap = bootstrap
+        self.max_retries = max_retries
+        self.anki = AnkiConnect(
+            self._Anki_URL, anki_chunk_size, anki_pause, self.metrics, anki_lock
+        )
+        self.health = HealthProbe(
+            self._Anki_URL, self._SiYuan_URL, metrics=self.metrics, anki_lock=self.anki.lock
+        )
         self._Anki_MODEL = Anki_Model
+        # notes of a named source are tagged syak::<source> and only those are its
+        # notes, several sources then share one model without deleting each other's
+        self.tag = f"syak::{source}" if source else None
+        # notebook (box) id -> deck name used instead of the notebook name
+        self.notebook_decks = notebook_decks or {}
         self.modle_fields = [
             "front",
             "back",
@@ -59,6 +1558,10 @@ class SYAK:
             "parent_hash",
             "deck",
         ]
+        # fields rebuilt when the block itself, its container parent or its deck changed
+        self.block_fields = ["front", "hash", "updated"]
+        self.parent_fields = ["back", "parent_id", "parent_hash", "parent_updated"]
+        self.deck_fields = ["deck", "hpath"]
         self._Anki_MODEL_CONFIG = {
             "modelName": self._Anki_MODEL,
             "inOrderFields": self.modle_fields,
@@ -70,102 +1573,187 @@ class SYAK:
             ],
         }
         self._media_regex = r"(?<=\(assets\/)[\w-]*\d{14}-\S{7}\.[\w]+(?=\))"
-        self._assets_regex = r"(?<=\()assets\/(?=[\w-]*\d{14}-\S{7}\.[\w]+\))"
-        self._ial_regex = r"{:[^\}]*\"}"
-        self._inline_eq_regex = r"(?<![\\\&])\$([^\$]+)\$(?!\$)"
-        self._eq_regex = r"(?<![\\])\$\$([^\$]+)\$\$"
-        self._sy_link_regex = r"(?<![\\])\(\((\d{14}-\S{7})\ [\'\"]([^\'\"]+)[\'\"]\)\)"
-        self.summary = []
+        # metrics of the last runs, a daemon keeps a bounded history
+        self.history = deque(maxlen=history)
 
-        self.con = sqlite3.connect(self._SiYuan_DB_PATH)
-        self.actions_json = {}
+        if siyuan_source == "http":
+            self.db = SiYuanHTTP(
+                self._SiYuan_URL, parent_depth, parent_types, include, exclude, metrics=self.metrics
+            )
+        else:
+            self.db = SiYuanDB(self._SiYuan_DB_PATH, parent_depth, parent_types, include, exclude)
+        state_path = Path(state_path or default_state_path(SiYuan_PATH, Anki_Model))
+        self.state = SyncState(state_path)
+        self._package_path = state_path.with_suffix(".apkg")
+        self.renderer = Renderer(
+            RenderCache(state_path.parent / "render-cache.db", render_cache_size << 20)
+            if render_cache_size
+            else None,
+            workers=workers,
+            renderer=renderer,
+        )
+        self._fingerprint = None
+        self._data_version = None
         pass
 
+    @timed("unchanged")
+    def unchanged(self, custom_deck=None):
+        # cheapest first: same connection saw no commits, then the database files
+        # look the same, then the card blocks and their parents look the same as
+        # at the end of the last successful run
+        self._fingerprint = None
+        if self.state.retries_due(time.time(), self.max_retries):
+            return False
+        # a renamed notebook only rewrites its conf.json, siyuan.db stays the same,
+        # and the decks of the config name notebooks as well
+        notebooks = [self.notebook_files(), sorted(self.notebook_decks.items())]
+        version = self.db.data_version()
+        if version is not None and self._data_version == (version, custom_deck, notebooks):
+            return True
+        files = []
+        for path in [self._SiYuan_DB_PATH, Path(f"{self._SiYuan_DB_PATH}-wal")]:
+            try:
+                stat = path.stat()
+                files.append([stat.st_mtime_ns, stat.st_size])
+            except OSError:
+                files.append(None)
+        # a database read over http may not be on this machine at all
+        files = (
+            json.dumps([custom_deck, self.db.parents_key(), files, notebooks])
+            if any(files)
+            else None
+        )
+        if files is not None and files == self.state.get_meta("files_fingerprint"):
+            self._data_version = (version, custom_deck, notebooks)
+            return True
+        try:
+            # card documents may be created, renamed or removed while a daemon runs,
+            # that is a commit the cheaper checks above already noticed
+            card_docs = self.db.card_docs(refresh=True)
+            fingerprint = self.db.cards_fingerprint()
+            # deck names come from the notebook names or the decks of the config
+            decks = sorted(self.notebooks().items())
+        except (requests.RequestException, SiYuanError) as e:
+            # read over http, SiYuan is not reachable and the health check says so
+            logging.debug(f"cards fingerprint: {e}")
+            return False
+        cards = json.dumps([custom_deck, self.db.parents_key(), card_docs, decks, fingerprint])
+        self._fingerprint = ((version, custom_deck, notebooks), files, cards)
+        if cards == self.state.get_meta("cards_fingerprint"):
+            self.remember_fingerprint()
+            return True
+        return False
+
+    def notebook_files(self):
+        files = []
+        for path in sorted(Path(self._SiYuan_PATH, "data").glob("*/.siyuan/conf.json")):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append([path.parent.parent.name, stat.st_mtime_ns, stat.st_size])
+        return files
+
+    def remember_fingerprint(self):
+        if self._fingerprint is None:
+            return
+        self._data_version, files, cards = self._fingerprint
+        with self.state.con:
+            self.state.set_meta("files_fingerprint", files)
+            self.state.set_meta("cards_fingerprint", cards)
+
+    def incremental(self, incremental):
+        # the watermark only covers cards whose backs followed the same rules, a
+        # changed --parent-depth or --parent-types needs a full run
+        return (
+            incremental
+            and self.state.watermark is not None
+            and self.state.get_meta("parents") == self.db.parents_key()
+        )
+
+    def remember_parents(self):
+        with self.state.con:
+            self.state.set_meta("parents", self.db.parents_key())
+
     def check_procs(self):
-        return find_procs_by_name("anki") & find_procs_by_name("siyuan")
+        return self.health()
 
+    @timed("check_model")
     def check_anki_model(self):
-        resp = requests.post(
-            self._Anki_URL, json={"action": "modelNames", "version": 6}
-        )
-        exist_models = pd.Series(resp.json()["result"], name="Anki_model")
+        exist_models = self.anki.invoke("modelNames")
 
-        if self._Anki_MODEL not in exist_models.values:
+        if self._Anki_MODEL not in exist_models:
             logging.warning("Anki model do not exists.")
-            resp = requests.post(
-                self._Anki_URL,
-                json={
-                    "action": "createModel",
-                    "version": 6,
-                    "params": self._Anki_MODEL_CONFIG,
-                },
-            )
-            if resp.status_code == 200:
+            try:
+                self.anki.invoke("createModel", **self._Anki_MODEL_CONFIG)
                 logging.info("Anki model created.")
-            else:
-                logging.error("Anki model created failed.")
-                sys.exit(1)
-
-    @log
-    def process_invoke(self):
-        actions = [
-            "createDeck",
-            "addNotes",
-            "updateNoteFields",
-            "storeMediaFile",
-            "changeDeck",
-            "deleteNotes",
-        ]
-        for act in actions:
-            if act in self.actions_json:
+            except (requests.RequestException, AnkiConnectError):
+                # another source of the same daemon may have created it meanwhile
+                if self._Anki_MODEL not in self.anki.invoke("modelNames"):
+                    logging.error("Anki model created failed.")
+                    sys.exit(1)
+
+    invoke_order = [
+        "createDeck",
+        "addNotes",
+        "importPackage",
+        "updateNoteFields",
+        "storeMediaFile",
+        "changeDeck",
+        "deleteNotes",
+    ]
+
+    def process_invoke(self, plan: SyncPlan, results: dict, actions=None, down=None):
+        # every action gets its own result, a failed note does not hide the others;
+        # once Anki stops answering the rest of the plan fails without being sent,
+        # returns that error, None when Anki answered all of it
+        for act in actions or self.invoke_order:
+            if act in plan.actions:
                 logging.debug(f"invoke {act}")
-                resp = requests.post(self._Anki_URL, json=self.actions_json[act])
-                if resp.status_code == 200:
-                    logging.info(f"{act}:{resp.json()}")
-                else:
-                    logging.error(f"{act}:{resp.json()}")
-                    return
+                results[act], down = self.send(act, plan.actions[act], down)
+        return down
 
-    def anki_notes(self, model):
-        resp = requests.post(
-            self._Anki_URL,
-            json={
-                "action": "findNotes",
-                "version": 6,
-                "params": {"query": f'"note:{model}"'},
-            },
-        )
-        if resp.status_code != 200:
-            return
-        notes = resp.json()["result"]
+    def send(self, act, actions, down=None, name=None):
+        # results of actions, one per action even when Anki stopped answering on the
+        # way (down is that error), the actions left then fail with it
+        name = name or act
+        results = []
+        if down is None:
+            try:
+                with self.metrics.phase(f"invoke:{name}"):
+                    for x in self.anki.stream(actions):
+                        results.extend(x)
+            except (requests.RequestException, AnkiConnectError) as e:
+                logging.error(f"{name}:{e}")
+                self.metrics.status = "failed"
+                down = e
+        results.extend({"result": None, "error": str(down)} for _ in actions[len(results) :])
+        self.log_results(name, results)
+        return results, down
+
+    def log_results(self, act, results):
+        errors = [x["error"] for x in results if x["error"]]
+        self.metrics.count(f"failed:{act}", len(errors))
+        if errors:
+            logging.error(f"{act}: {len(errors)} failed, {errors[:5]}")
+        logging.info(f"{act}: {len(results) - len(errors)} done")
+
+    @staticmethod
+    def failed(results, act):
+        return [x["error"] is not None for x in results.get(act, [])]
+
+    def find_notes(self, query):
+        return self.anki.invoke("findNotes", query=query)
+
+    def notes_info(self, notes):
+        notes = list(notes)
         if len(notes) == 0:
-            return pd.DataFrame(
-                [],
-                columns=[
-                    "note_id",
-                    "id",
-                    "note_parent_id",
-                    "note_hpath",
-                    "note_hash",
-                    "note_updated",
-                    "note_parent_updated",
-                    "note_parent_hash",
-                    "note_deck",
-                    "cards",
-                ],
-            )
-        resp = requests.post(
-            self._Anki_URL,
-            json={
-                "action": "notesInfo",
-                "version": 6,
-                "params": {
-                    "notes": notes,
-                },
-            },
-        )
-        notes_info = resp.json()["result"]
-        exist = list(
+            return []
+        notes_info = []
+        for x in chunks(notes, self.anki.chunk_size):
+            notes_info.extend(self.anki.invoke("notesInfo", notes=x))
+        notes_info = filter(lambda x: x.get("noteId"), notes_info)
+        return list(
             map(
                 lambda x: {
                     "note_id": x["noteId"],
@@ -182,425 +1770,926 @@ class SYAK:
                 notes_info,
             )
         )
-        return pd.DataFrame(exist)
 
-    def create_deck(self, deck: Iterable):
-        create_deck_json = list(
-            map(
-                lambda x: {"action": "createDeck", "version": 6, "params": {"deck": x}},
-                deck,
-            )
-        )
-        create_deck_json = {
-            "action": "multi",
-            "version": 6,
-            "params": {"actions": create_deck_json},
-        }
-        self.actions_json["createDeck"] = create_deck_json
-        return create_deck_json
+    def notes_mod_time(self, notes):
+        try:
+            mods = self.anki.invoke("notesModTime", notes=list(notes))
+        except AnkiConnectError:
+            # AnkiConnect before 2023 has no notesModTime
+            return
+        return {x["noteId"]: x["mod"] for x in mods}
 
-    def get_deck_info(self, deck: pd.DataFrame, preserve_deck="(default)"):
-        query_deck_json = list(
-            map(
-                lambda x: {
-                    "action": "findCards",
-                    "version": 6,
-                    "params": {
-                        "query": f'"deck:{x}"',
-                    },
-                },
-                deck["deck"],
+    @timed("anki_notes")
+    def anki_notes(self, model, ids=None):
+        # revalidate the local mirror instead of dumping every note with notesInfo:
+        # only notes unknown to the mirror or edited in Anki since the last check
+        # are fetched, notes gone from Anki are dropped
+        checked = self.state.get_meta("notes_checked")
+        now = time.time()
+        query = f'"note:{model}"'
+        if self.tag:
+            query += f' "tag:{self.tag}"'
+            if checked is None:
+                self.adopt_notes(model)
+        live = self.find_notes(query)
+        if checked is None:
+            self.state.save_notes(self.notes_info(live), replace=True)
+        else:
+            # edited:n counts scheduler days, one more covers an edit made before
+            # the last rollover, notesModTime drops the extra notes
+            days = max(1, math.ceil((now - float(checked)) / 86400)) + 1
+            edited = self.find_notes(f"{query} edited:{days}")
+            known = self.state.note_ids()
+            live = set(live)
+            edited = set(edited) & known
+            # notes SYAK wrote itself also count as edited, skip those untouched since
+            mods = self.notes_mod_time(edited) if edited else {}
+            if mods is not None:
+                synced = self.state.note_mods()
+                edited = {x for x in edited if mods.get(x, math.inf) > synced[x]}
+            self.state.drop_notes(known - live)
+            self.state.save_notes(self.notes_info((live - known) | edited))
+        self.state.set_meta("notes_checked", now)
+        return self.state.notes(ids)
+
+    def adopt_notes(self, model):
+        # notes synced before the source had a tag are taken over by block id, so
+        # they keep their review history instead of being added again
+        untagged = self.find_notes(f'"note:{model}" -tag:syak::*')
+        if not untagged:
+            return
+        ids = {x["id"] for x in self.db.card_index()}
+        notes = [x["note_id"] for x in self.notes_info(untagged) if x["id"] in ids]
+        if notes:
+            self.anki.invoke("addTags", notes=notes, tags=self.tag)
+            logging.info(f"tagged {len(notes)} notes with {self.tag}")
+
+    def notes_from_results(self, results, create, update, delete):
+        # keep the mirror in step with what addNotes/updateNoteFields/deleteNotes
+        # did, returns ids of the blocks Anki did not take and of those it is not
+        # known whether it took
+        failed, unchecked = [], []
+        if "addNotes" in results and create:
+            created = []
+            for x, result in zip(create, results["addNotes"]):
+                if result["result"] is None:
+                    failed.append(x["id"])
+                else:
+                    created.append(dict(x, note_id=result["result"]))
+            find_cards_json = list(
+                map(lambda x: self.anki.action("findCards", query=f"nid:{x['note_id']}"), created)
             )
-        )
-        query_deck_json = {
-            "action": "multi",
-            "version": 6,
-            "params": {"actions": query_deck_json},
+            try:
+                for x, cards in zip(created, self.anki.multi(find_cards_json)):
+                    x["cards"] = cards["result"] or []
+                self.state.save_notes(SyncState.notes_from_blocks(created))
+            except (requests.RequestException, AnkiConnectError) as e:
+                # the notes are in Anki, the mirror finds them on the next run
+                logging.error(f"findCards:{e}")
+        if "importPackage" in results and create:
+            # a package reports no result per note, the notes Anki has after the
+            # import tell which ones it took
+            self._package_path.unlink(missing_ok=True)
+            if any(self.failed(results, "importPackage")):
+                failed.extend(x["id"] for x in create)
+            else:
+                try:
+                    self.anki_notes(self._Anki_MODEL, ids=())
+                    imported = self.state.note_block_ids()
+                    failed.extend(x["id"] for x in create if x["id"] not in imported)
+                except (requests.RequestException, AnkiConnectError) as e:
+                    # synced again on the next run, after its mirror check saw what
+                    # the package brought in
+                    logging.error(f"importPackage:{e}")
+                    self.metrics.status = "failed"
+                    unchecked.extend(x["id"] for x in create)
+        if "updateNoteFields" in results and update:
+            update_failed = self.failed(results, "updateNoteFields")
+            failed.extend(x["id"] for x, f in zip(update, update_failed) if f)
+            update = [x for x, f in zip(update, update_failed) if not f]
+            self.state.save_notes(SyncState.notes_from_blocks(update))
+        if "deleteNotes" in results and delete:
+            if any(self.failed(results, "deleteNotes")):
+                failed.extend(x["id"] for x in delete)
+            else:
+                self.state.drop_notes(x["note_id"] for x in delete)
+        return failed, unchecked
+
+    def create_deck(self, deck: Iterable):
+        return list(map(lambda x: self.anki.action("createDeck", deck=x), deck))
+
+    def empty_decks(self, touched: Iterable, exist_decks: Iterable, preserve_deck="(default)"):
+        # only decks SYAK owns and touched this run, and their ancestors, can have
+        # become empty, count their cards with one getDeckStats call
+        owned = self.state.decks()
+        exist_decks = set(exist_decks)
+        touched = {x for deck in touched if deck for x in deck_ancestors(deck)}
+        touched = {
+            x
+            for x in touched & owned & exist_decks
+            if not re.match(preserve_deck, x, re.IGNORECASE)
+        }
+        if not touched:
+            return []
+        subtree = {
+            x: [d for d in exist_decks if d == x or d.startswith(x + "::")]
+            for x in touched
         }
-        resp = requests.post(self._Anki_URL, json=query_deck_json)
-        deck["count"] = list(map(lambda x: len(x["result"]), resp.json()["result"]))
-        del_deck = deck["deck"][deck["count"] == 0].tolist()
-        del_deck = list(
-            filter(lambda x: not re.match(preserve_deck, x, re.IGNORECASE), del_deck)
+        stats = self.anki.invoke(
+            "getDeckStats", decks=sorted({d for x in subtree.values() for d in x})
+        )
+        count = {x["name"]: x["total_in_deck"] for x in stats.values()}
+        # a deck is only empty when its whole subtree is, unknown decks are kept
+        del_deck = [
+            x for x, sub in subtree.items() if all(count.get(d, 1) == 0 for d in sub)
+        ]
+        # deleting a parent deletes its children as well
+        return sorted(
+            x for x in del_deck if not any(x.startswith(d + "::") for d in del_deck)
         )
-        return del_deck
 
     def delete_decks(self, del_deck):
-        delete_decks_json = {
-            "action": "deleteDecks",
-            "version": 6,
-            "params": {
-                "decks": del_deck,
-                "cardsToo": True,
-            },
-        }
-        resp = requests.post(self._Anki_URL, json=delete_decks_json)
-        if resp.status_code == 200:
-            logging.info(f"deleteDecks:{resp.json()}")
-
-    def media_from_blocks(self, blocks: pd.DataFrame):
-        media = pd.concat(
-            [
-                blocks["markdown"]
-                .str.findall(self._media_regex)
-                .explode(ignore_index=True),
-                blocks["parent_markdown"]
-                .str.findall(self._media_regex)
-                .explode(ignore_index=True),
-            ]
+        try:
+            resp = self.anki.invoke("deleteDecks", decks=del_deck, cardsToo=True)
+            logging.info(f"deleteDecks:{resp}")
+            self.state.drop_decks(del_deck)
+        except (requests.RequestException, AnkiConnectError) as e:
+            logging.error(f"deleteDecks:{e}")
+
+    @timed("media")
+    def media_from_blocks(self, blocks: list):
+        # files to store as (filename, size, mtime, sha1, changed, missing from Anki)
+        media = unique(
+            x
+            for field in ["markdown", "parent_markdown"]
+            for block in blocks
+            for x in re.findall(self._media_regex, block[field] or "")
         )
-        media = media.to_frame("filename")
-        media.dropna(inplace=True)
-        if media.empty:
-            return
-        media["path"] = (self._SiYuan_ASSETS_PATH / media["filename"]).astype(str)
-        media_json = media.to_dict(orient="records")
-        media_json = list(
+        if len(media) == 0:
+            return []
+
+        # only store files Anki does not have or that changed since they were stored
+        stored = self.state.media()
+        pending = []
+        for filename in media:
+            path = self._SiYuan_ASSETS_PATH / filename
+            try:
+                stat = path.stat()
+            except OSError:
+                logging.warning(f"media {filename} does not exist.")
+                continue
+            known = stored.get(filename)
+            if known and known[:2] == (stat.st_size, stat.st_mtime):
+                sha1 = known[2]
+            else:
+                sha1 = hashlib.sha1(path.read_bytes()).hexdigest()
+            pending.append(
+                (filename, stat.st_size, stat.st_mtime, sha1, known is None or known[2] != sha1)
+            )
+        if not pending:
+            return []
+        anki_media = set(
+            self.anki.invoke("getMediaFilesNames", pattern="*-??????????????-???????.*")
+        )
+        # files Anki already has are settled, refresh their stat so they are not hashed again
+        self.state.save_media(x[:4] for x in pending if not x[4] and x[0] in anki_media)
+        return [
+            x + (x[0] not in anki_media,) for x in pending if x[4] or x[0] not in anki_media
+        ]
+
+    def store_media(self, media):
+        return list(
             map(
-                lambda x: {
-                    "action": "storeMediaFile",
-                    "version": 6,
-                    "params": x,
-                },
-                media_json,
+                lambda x: self.anki.action(
+                    "storeMediaFile",
+                    filename=x[0],
+                    path=str(self._SiYuan_ASSETS_PATH / x[0]),
+                ),
+                media,
             )
         )
-        media_json = {
-            "action": "multi",
-            "version": 6,
-            "params": {"actions": media_json},
-        }
-        self.actions_json["storeMediaFile"] = media_json
-        return media_json
-
-    def merge_parent_blocks(self, blocks):
-        parent_ids = tuple(blocks["parent_id"].tolist())
-        if len(parent_ids) == 1:
-            parent_ids = f'("{parent_ids[0]}")'
-        sql = f"select * from blocks where id in {parent_ids} and type in ('l', 'i', 'b', 's')"
-        parent = pd.read_sql(sql, self.con)
-        parent = parent[["id", "markdown", "updated", "hash"]].rename(
-            {
-                "id": "parent_id",
-                "markdown": "parent_markdown",
-                "updated": "parent_updated",
-                "hash": "parent_hash",
-            },
-            axis=1,
-        )
-        blocks = blocks.merge(parent, "left", on="parent_id")
-        blocks.fillna(
-            {
-                "parent_markdown": "",
-                "parent_updated": "",
-                "parent_hash": "",
-            },
-            inplace=True,
+
+    def media_from_results(self, plan: SyncPlan, results):
+        if "storeMediaFile" in results:
+            stored = [
+                x[:4]
+                for x, failed in zip(plan.media, self.failed(results, "storeMediaFile"))
+                if not failed
+            ]
+            self.metrics.count("media", len(stored))
+            self.state.save_media(stored)
+        if plan.packaged and not any(self.failed(results, "importPackage")):
+            self.metrics.count("media", len(plan.packaged))
+            self.state.save_media(x[:4] for x in plan.packaged)
+
+    def block_decks(self, blocks, sy_notebook, custom_deck=None):
+        # sy_notebook maps box ids to names, blocks of closed notebooks get no deck
+        if custom_deck is not None:
+            custom_deck = custom_deck.strip("/")
+        for x in blocks:
+            deck = sy_notebook.get(x["box"])
+            if deck is None or x["hpath"] is None:
+                x["deck"] = None
+                continue
+            deck += x["hpath"]
+            if custom_deck is not None and deck.startswith(custom_deck):
+                deck = custom_deck
+            x["deck"] = deck.replace("/", "::")
+        return blocks
+
+    def card_blocks(self, sy_notebook, custom_deck=None):
+        blocks = self.db.card_blocks()
+        if not blocks:
+            return None
+        return self.block_decks(blocks, sy_notebook, custom_deck)
+
+    @staticmethod
+    def since(updated):
+        since = datetime.strptime(updated, "%Y%m%d%H%M%S")
+        return (since - WATERMARK_MARGIN).strftime("%Y%m%d%H%M%S")
+
+    def card_ids(self, sy_notebook, custom_deck=None, incremental=False):
+        # sorted ids of the cards to sync and ids of the cards gone from SiYuan,
+        # incremental runs only pick blocks updated since the last synced
+        # watermark, blocks of updated parents, new card refs and moved blocks
+        current = self.block_decks(self.db.card_index(), sy_notebook, custom_deck)
+        known = {x["id"]: x["deck"] for x in self.state.blocks()}
+
+        current_ids = {x["id"] for x in current}
+        if incremental:
+            changed = {x["id"] for x in current if known.get(x["id"]) != x["deck"]}
+            changed.update(self.db.changed_card_ids(self.since(self.state.watermark)))
+        else:
+            changed = current_ids
+            known.update(dict.fromkeys(self.state.note_block_ids() - known.keys()))
+        deleted = [x for x in known if x not in current_ids]
+        return sorted(changed), deleted
+
+    def changed_card_blocks(self, sy_notebook, custom_deck=None):
+        changed, deleted = self.card_ids(sy_notebook, custom_deck, incremental=True)
+        blocks = self.db.card_blocks(changed)
+        return self.block_decks(blocks, sy_notebook, custom_deck), deleted
+
+    @timed("render")
+    def render_notes(self, blocks, front=None, back=None):
+        # front and back select the rows to render that side for, all by default,
+        # back is the rendered parent, render it once per parent and share the html
+        # among its children
+        fronts = blocks if front is None else [x for x, f in zip(blocks, front) if f]
+        backs = blocks if back is None else [x for x, b in zip(blocks, back) if b]
+        parents = list({x["parent_id"]: x for x in backs[::-1]}.values())
+        html = self.renderer.render_many(
+            [x["markdown"] for x in fronts] + [x["parent_markdown"] for x in parents]
         )
+        for x, front_html in zip(fronts, html):
+            x["front"] = f'{front_html}<p><a href="siyuan://blocks/{x["id"]}">SiYuanURL</a></p>'
+        back_html = dict(zip((x["parent_id"] for x in parents), html[len(fronts) :]))
+        for x in backs:
+            x["back"] = back_html[x["parent_id"]]
         return blocks
 
     def add_notes(self, create):
-        # todo merge series process
-        create["front"] = (
-            create["markdown"]
-            # .str.replace("\n\n", "\n")  # remove empty line
-            .str.replace(self._assets_regex, "", regex=True)
-            .str.replace(self._ial_regex, " ", regex=True)
-            .str.replace(
-                self._sy_link_regex,
-                lambda x: f"[{x.group(2)}](siyuan://blocks/{x.group(1)})",
-                regex=True,
-            )
-            .apply(markdown)
-            .str.replace(
-                self._inline_eq_regex,
-                lambda x: x.group().strip("$").join(["\\(", "\\)"]),
-                regex=True,
-            )
-            .str.replace(
-                self._eq_regex,
-                lambda x: x.group().strip("$").join(["\\[", "\\]"]),
-                regex=True,
-            )
-            + '<p><a href="siyuan://blocks/'
-            + create["id"]
-            + '">'
-            + "SiYuanURL"
-            + "</a></p>"
-        )
-        create["back"] = (
-            create["parent_markdown"]
-            # .str.replace("\n\n", "\n")  # remove empty line
-            .str.replace(self._assets_regex, "", regex=True)
-            .str.replace(self._ial_regex, " ", regex=True)
-            .str.replace(
-                self._sy_link_regex,
-                lambda x: f"[{x.group(2)}](siyuan://blocks/{x.group(1)})",
-                regex=True,
-            )
-            .apply(markdown)
-            .str.replace(
-                self._inline_eq_regex,
-                lambda x: x.group().strip("$").join(["\\(", "\\)"]),
-                regex=True,
-            )
-            .str.replace(
-                self._eq_regex,
-                lambda x: x.group().strip("$").join(["\\[", "\\]"]),
-                regex=True,
-            )
-        )
-        notes = create[self.modle_fields].to_dict(orient="records")
-        notes = list(
+        self.render_notes(create)
+        notes = [{k: x[k] for k in self.modle_fields} for x in create]
+        # one addNote per note instead of addNotes, so every note reports its own result
+        return list(
             map(
-                lambda x: {
-                    "deckName": x["deck"],
-                    "modelName": self._Anki_MODEL,
-                    "fields": x,
-                },
+                lambda x: self.anki.action(
+                    "addNote",
+                    note={
+                        "deckName": x["deck"],
+                        "modelName": self._Anki_MODEL,
+                        "fields": x,
+                        "tags": [self.tag] if self.tag else [],
+                    },
+                ),
                 notes,
             )
         )
-        add_notes_json = {
-            "action": "addNotes",
-            "version": 6,
-            "params": {"notes": notes},
-        }
-        self.actions_json["addNotes"] = add_notes_json
-        return add_notes_json
+
+    def package_notes(self, create, media):
+        # write the new notes and the media only they use into a package for
+        # importPackage, None when Anki does not describe the model
+        try:
+            model = self.anki.invoke("findModelsByName", modelNames=[self._Anki_MODEL])[0]
+        except (requests.RequestException, AnkiConnectError, IndexError) as e:
+            logging.warning(f"findModelsByName:{e}, adding notes one by one.")
+            return None
+        self.render_notes(create)
+        with self.metrics.phase("package"):
+            package = AnkiPackage(model, [self.tag] if self.tag else [])
+            for x in create:
+                package.add_note(x["id"], {k: x[k] for k in self.modle_fields}, x["deck"])
+            package.write(self._package_path, (self._SiYuan_ASSETS_PATH / x[0] for x in media))
+        return [self.anki.action("importPackage", path=str(self._package_path.resolve()))]
 
     def update_notes(self, n):
-        n["front"] = (
-            n["markdown"]
-            # .str.replace("\n\n", "\n")  # remove empty line
-            .str.replace(self._assets_regex, "", regex=True)
-            .str.replace(self._ial_regex, " ", regex=True)
-            .str.replace(
-                self._sy_link_regex,
-                lambda x: f"[{x.group(2)}](siyuan://blocks/{x.group(1)})",
-                regex=True,
-            )
-            .apply(markdown)
-            .str.replace(
-                self._inline_eq_regex,
-                lambda x: x.group().strip("$").join(["\\(", "\\)"]),
-                regex=True,
-            )
-            .str.replace(
-                self._eq_regex,
-                lambda x: x.group().strip("$").join(["\\[", "\\]"]),
-                regex=True,
-            )
-            + '<p><a href="siyuan://blocks/'
-            + n["id"]
-            + '">'
-            + "SiYuanURL"
-            + "</a></p>"
-        )
-        n["back"] = (
-            n["parent_markdown"]
-            # .str.replace("\n\n", "\n")  # remove empty line
-            .str.replace(self._assets_regex, "", regex=True)
-            .str.replace(self._ial_regex, " ", regex=True)
-            .str.replace(
-                self._sy_link_regex,
-                lambda x: f"[{x.group(2)}](siyuan://blocks/{x.group(1)})",
-                regex=True,
-            )
-            .apply(markdown)
-            .str.replace(
-                self._inline_eq_regex,
-                lambda x: x.group().strip("$").join(["\\(", "\\)"]),
-                regex=True,
-            )
-            .str.replace(
-                self._eq_regex,
-                lambda x: x.group().strip("$").join(["\\[", "\\]"]),
-                regex=True,
-            )
-        )
-        update_note_fields_json = n[self.modle_fields + ["note_id"]].to_dict(
-            orient="records"
-        )
-
-        update_note_fields_json = list(
-            map(
-                lambda x: {
-                    "action": "updateNoteFields",
-                    "version": 6,
-                    "params": {
-                        "note": {
-                            "id": x.pop("note_id"),
-                            "fields": x,
-                        }
-                    },
-                },
-                update_note_fields_json,
+        # only rebuild and send the fields of what changed, a moved note does not
+        # resend its html and an edited parent does not re-render the front
+        changed = [
+            (
+                x["note_hash"] != x["hash"],
+                x["note_parent_hash"] != x["parent_hash"],
+                x["note_deck"] != x["deck"],
             )
-        )
-        update_note_fields_json = {
-            "action": "multi",
-            "version": 6,
-            "params": {"actions": update_note_fields_json},
-        }
-        self.actions_json["updateNoteFields"] = update_note_fields_json
+            for x in n
+        ]
+        self.render_notes(n, front=[x[0] for x in changed], back=[x[1] for x in changed])
+        update_note_fields_json = []
+        for x, (block, parent, deck) in zip(n, changed):
+            fields = (
+                (self.block_fields if block else [])
+                + (self.parent_fields if parent else [])
+                + (self.deck_fields if deck else [])
+            )
+            update_note_fields_json.append(
+                self.anki.action(
+                    "updateNoteFields",
+                    note={"id": x["note_id"], "fields": {k: x[k] for k in fields}},
+                )
+            )
+        self.metrics.count("update:front", sum(x[0] for x in changed))
+        self.metrics.count("update:back", sum(x[1] for x in changed))
+        self.metrics.count("update:deck", sum(x[2] for x in changed))
         return update_note_fields_json
 
-    def update_deck(self, deck: pd.DataFrame):
+    def update_deck(self, move: list):
         # change the oldest card deck
-        deck = deck.explode("cards", ignore_index=True)
-        deck.sort_values(by=["note_id", "cards"], inplace=True)
-        deck = deck.groupby(by=["note_id"], sort=False).first().reset_index()
-        deck = deck[["deck", "cards"]].groupby("deck")
+        cards = {}
+        for x in sorted((x for x in move if x["cards"]), key=lambda x: x["note_id"]):
+            cards.setdefault(x["deck"], []).append(min(x["cards"]))
 
-        change_deck_json = list(
+        return list(
             map(
-                lambda x: {
-                    "action": "changeDeck",
-                    "version": 6,
-                    "params": {
-                        "cards": x[1]["cards"].tolist(),
-                        "deck": x[0],
-                    },
-                },
-                deck,
+                lambda x: self.anki.action("changeDeck", cards=cards[x], deck=x),
+                sorted(cards),
             )
         )
-        change_deck_json = {
-            "action": "multi",
-            "version": 6,
-            "params": {"actions": change_deck_json},
-        }
-        self.actions_json["changeDeck"] = change_deck_json
-        return change_deck_json
 
     def delete_notes(self, delete):
-        ids = delete["note_id"].tolist()
-        delete_notes_json = {
-            "action": "deleteNotes",
-            "version": 6,
-            "params": {"notes": ids},
-        }
-        self.actions_json["deleteNotes"] = delete_notes_json
-        return delete_notes_json
+        return [self.anki.action("deleteNotes", notes=[x["note_id"] for x in delete])]
+
+    def siyuan(self, api, payload=None):
+        s = time.perf_counter()
+        resp = requests.post(self._SiYuan_URL + api, json=payload)
+        self.metrics.request(
+            api, time.perf_counter() - s, len(resp.request.body or b""), len(resp.content)
+        )
+        return resp
 
     def send_finish(self, msg=""):
-        resp = requests.post(
-            self._SiYuan_URL + "/api/notification/pushMsg",
-            json={"msg": f"Anki sync finished\n{msg}", "timeout": 5000},
+        resp = self.siyuan(
+            "/api/notification/pushMsg",
+            {"msg": f"Anki sync finished\n{msg}", "timeout": 5000},
         )
         pass
 
-    @log
-    def run(self, custom_deck=None):
-        if not self.check_procs():
-            logging.warning("Anki/SiYuan not running!")
-            return
-
-        # get SiYuan notebooks
-        resp = requests.post(
-            self._SiYuan_URL + "/api/notebook/lsNotebooks",
-        )
+    @timed("notebooks")
+    def notebooks(self):
+        resp = self.siyuan("/api/notebook/lsNotebooks")
         sy_notebook = resp.json()["data"]["notebooks"]
         if len(sy_notebook) < 0:
             logging.warning("SiYuan notebooks do not exists.")
             return
-        sy_notebook = pd.DataFrame(sy_notebook)[["id", "name"]].rename(
-            {"id": "box", "name": "boxName"}, axis=1
+        return {x["id"]: self.notebook_decks.get(x["id"], x["name"]) for x in sy_notebook}
+
+    @timed("fetch")
+    def fetch(self, sy_notebook, custom_deck=None, incremental=False):
+        # card blocks to diff, and on incremental runs the ids of removed cards
+        if incremental:
+            return self.changed_card_blocks(sy_notebook, custom_deck)
+        blocks = self.card_blocks(sy_notebook, custom_deck)
+        if blocks is None:
+            logging.warning("SiYuan does not any card.")
+            return
+        return blocks, None
+
+    @timed("diff")
+    def diff(self, blocks, deleted, exists, exist_decks):
+        # blocks of notebooks SiYuan did not list have no deck, their notes are
+        # left as they are until the notebook is back
+        skipped = {x["id"] for x in blocks if x["deck"] is None}
+        if skipped:
+            logging.warning(f"{len(skipped)} cards skipped, their notebook is closed or missing.")
+            blocks = [x for x in blocks if x["id"] not in skipped]
+            exists = [x for x in exists if x["id"] not in skipped]
+        by_id = {x["id"]: x for x in blocks}
+        if deleted is None:
+            delete = [x for x in exists if x["id"] not in by_id]
+        else:
+            deleted_ids = set(deleted)
+            delete = [x for x in exists if x["id"] in deleted_ids]
+        remain = [dict(x, **by_id[x["id"]]) for x in exists if x["id"] in by_id]
+        remain_ids = {x["id"] for x in remain}
+        create = [x for x in blocks if x["id"] not in remain_ids]
+        # update_notes works out which fields of these changed
+        update = [
+            x
+            for x in remain
+            if x["note_hash"] != x["hash"]
+            or x["note_deck"] != x["deck"]
+            or x["note_parent_hash"] != x["parent_hash"]
+        ]
+        move = [x for x in remain if x["note_deck"] != x["deck"]]
+        exist_decks = set(exist_decks)
+        new_decks = unique(
+            x["deck"] for x in create + move if x["deck"] not in exist_decks
+        )
+        return self.hold_back(SyncDiff(blocks, create, update, move, delete, deleted, new_decks))
+
+    @staticmethod
+    def block_state(block):
+        return json.dumps([block["hash"], block["parent_hash"], block["deck"]])
+
+    def hold_back(self, sync: SyncDiff):
+        # notes with an action queued for retry are left to the queue, neither sent
+        # again nor remembered as synced, unless their block changed since, then
+        # the queued action is stale and the note is synced as usual
+        queued = self.state.retry_states()
+        if not queued:
+            return sync
+        current = {x["id"]: self.block_state(x) for x in sync.blocks}
+        stale = {x for x, state in queued.items() if x in current and current[x] != state}
+        self.state.drop_block_retries(stale)
+        held = set(queued) - stale
+        if not held:
+            return sync
+
+        def keep(notes):
+            return [x for x in notes if x["id"] not in held]
+
+        self.metrics.count(
+            "held", sum(x["id"] in held for x in sync.create + sync.update + sync.delete)
+        )
+        return SyncDiff(
+            keep(sync.blocks),
+            keep(sync.create),
+            keep(sync.update),
+            keep(sync.move),
+            keep(sync.delete),
+            sync.deleted,
+            sync.new_decks,
+        )
+
+    def plan(self, sync, render=True):
+        # build the actions of this run, notes are only rendered when render is set
+        self.metrics.count("create", len(sync.create))
+        self.metrics.count("update", len(sync.update))
+        self.metrics.count("move", len(sync.move))
+        self.metrics.count("delete", len(sync.delete))
+        self.metrics.count("new_decks", len(sync.new_decks))
+        actions, summary = {}, []
+        media = sync.create + sync.update
+        media = self.media_from_blocks(media) if media else []
+        packaged = []
+        if sync.create:
+            summary.append(f"num of create: {len(sync.create)}")
+            if render and self.bootstrap:
+                # files Anki lacks that only new notes use go into the package
+                used = {
+                    x
+                    for block in sync.create
+                    for field in ["markdown", "parent_markdown"]
+                    for x in re.findall(self._media_regex, block[field] or "")
+                }
+                packaged = [x for x in media if x[5] and x[0] in used]
+                package = self.package_notes(sync.create, packaged)
+                if package is None:
+                    packaged = []
+                else:
+                    actions["importPackage"] = package
+                    media = [x for x in media if x not in packaged]
+            if render and "importPackage" not in actions:
+                actions["addNotes"] = self.add_notes(sync.create)
+        if sync.update:
+            summary.append(f"num of update: {len(sync.update)}")
+            if render:
+                actions["updateNoteFields"] = self.update_notes(sync.update)
+        if sync.move:
+            actions["changeDeck"] = self.update_deck(sync.move)
+        if sync.delete:
+            summary.append(f"num of delete: {len(sync.delete)}")
+            actions["deleteNotes"] = self.delete_notes(sync.delete)
+        if sync.new_decks:
+            actions["createDeck"] = self.create_deck(sync.new_decks)
+        if media:
+            actions["storeMediaFile"] = self.store_media(media)
+        self.metrics.summary = summary
+        return SyncPlan(
+            sync, MappingProxyType(actions), tuple(media), tuple(summary), tuple(packaged)
         )
 
+    @timed("finish")
+    def commit(self, plan: SyncPlan, results, watermark=True):
+        # remember what Anki holds now, returns the ids of blocks Anki did not take
+        sync = plan.diff
+        failed, unchecked = self.notes_from_results(
+            results, sync.create, sync.update, sync.delete
+        )
+        failed = set(failed)
+        self.metrics.count("failed", len(failed))
+        # only what surely failed is queued, a note added twice stays twice
+        self.queue_retries(self.retry_entries(plan, results, failed))
+        failed.update(unchecked)
+        self.media_from_results(plan, results)
+        blocks = [x for x in sync.blocks if x["id"] not in failed]
+        self.state.save_blocks(blocks, replace=sync.deleted is None, watermark=watermark)
+        if sync.deleted is not None:
+            self.state.drop_blocks(set(sync.deleted) - failed)
+        self.state.save_decks(
+            unique(sync.new_decks + [x["deck"] for x in sync.create + sync.update])
+        )
+        return failed
+
+    @staticmethod
+    def touched_decks(sync: SyncDiff):
+        # decks that may have been left empty by moved and deleted notes
+        return sync.new_decks + [x["note_deck"] for x in sync.move + sync.delete]
+
+    def clean_decks(self, touched, exist_decks):
+        with self.metrics.phase("deck_gc"):
+            try:
+                del_deck = self.empty_decks(unique(touched), exist_decks)
+            except (requests.RequestException, AnkiConnectError) as e:
+                # left for the next run that touches them
+                logging.error(f"getDeckStats:{e}")
+                self.metrics.status = "failed"
+                del_deck = []
+            if del_deck:
+                self.delete_decks(del_deck)
+        self.metrics.count("deleted_decks", len(del_deck))
+
+    def retry_entries(self, plan: SyncPlan, results, failed):
+        # what Anki did not take this run as entries of the retry queue, note
+        # actions one per note so that each one retries and gives up on its own;
+        # id and state tie an entry to a block for hold_back
+        sync = plan.diff
+        entries = []
+
+        def add(key, act, action, block=None):
+            entries.append(
+                {
+                    "key": f"{act}:{key}",
+                    "act": act,
+                    "action": json.dumps(action),
+                    "id": block["id"] if block else None,
+                    # deleted blocks have no state, any block of that id makes it stale
+                    "state": self.block_state(block) if block and "hash" in block else None,
+                    "error": None,
+                }
+            )
+
+        def failed_actions(act, items):
+            return [
+                (x, action)
+                for x, action, f in zip(items, plan.actions.get(act, []), self.failed(results, act))
+                if f
+            ]
+
+        for x, action in failed_actions("addNotes", sync.create):
+            add(x["id"], "addNotes", action, x)
+        if "importPackage" in results:
+            # the package is gone, notes it did not bring in are added one by one
+            create = [x for x in sync.create if x["id"] in failed]
+            for x, action in zip(create, self.add_notes(create)):
+                add(x["id"], "addNotes", action, x)
+            if any(self.failed(results, "importPackage")):
+                for x, action in zip(plan.packaged, self.store_media(plan.packaged)):
+                    add(x[0], "storeMediaFile", action)
+        for x, action in failed_actions("updateNoteFields", sync.update):
+            add(x["id"], "updateNoteFields", action, x)
+        # changeDeck moves the notes of one deck at once, the way update_deck sorts them
+        decks = sorted({x["deck"] for x in sync.move if x["cards"]})
+        decks = {x for x, _ in failed_actions("changeDeck", decks)}
+        for x in sync.move:
+            if x["cards"] and x["deck"] in decks:
+                # tied to the block, a later move makes it stale instead of undoing it
+                add(x["note_id"], "changeDeck", self.update_deck([x])[0], x)
+        if any(self.failed(results, "deleteNotes")):
+            for x in sync.delete:
+                add(x["note_id"], "deleteNotes", self.delete_notes([x])[0], {"id": x["id"]})
+        for x, action in failed_actions("storeMediaFile", plan.media):
+            add(x[0], "storeMediaFile", action)
+        for x, action in failed_actions("createDeck", sync.new_decks):
+            add(x, "createDeck", action)
+        return entries
+
+    def queue_retries(self, entries, now=None):
+        # entries failed once more, the next try backs off exponentially
+        now = now or time.time()
+        for x in entries:
+            x["attempts"] = x.get("attempts", 0) + 1
+            x["due"] = now + min(
+                self.retry_backoff * 2 ** (x["attempts"] - 1), self.retry_max_backoff
+            )
+        self.state.save_retries(entries)
+        self.metrics.count("queued", len(entries))
+
+    @timed("retry")
+    def replay(self, force=False):
+        # actions Anki did not take on earlier runs go first, each on its own
+        # backoff; what they change in Anki reaches the mirror like edits made in
+        # Anki do, so nothing else is recorded; force retries all of them now,
+        # given up ones included; returns whether Anki answered
+        now = time.time()
+        retries = self.state.retries()
+        due = [
+            x for x in retries if force or (x["due"] <= now and x["attempts"] < self.max_retries)
+        ]
+        done, again, down = [], [], None
+        for act in self.invoke_order:
+            entries = [x for x in due if x["act"] == act]
+            if not entries:
+                continue
+            actions = [json.loads(x["action"]) for x in entries]
+            results, down = self.send(act, actions, down, f"retry:{act}")
+            for x, result in zip(entries, results):
+                if result["error"] is None:
+                    done.append(x["key"])
+                else:
+                    again.append(dict(x, error=result["error"]))
+        self.state.drop_retries(done)
+        self.queue_retries(again, now)
+        self.metrics.count("retried", len(done))
+
+        # given up entries stay in the queue, and their notes held back, until the
+        # block changes or a forced run retries them
+        poison = [x for x in self.state.retries() if x["attempts"] >= self.max_retries]
+        self.metrics.count("poison", len(poison))
+        if poison:
+            logging.error(
+                f"gave up on {len(poison)} Anki actions after {self.max_retries} attempts, "
+                f"{[(x['key'], x['error']) for x in poison[:5]]}"
+            )
+        return down is None
+
+    def finish(self, plan: SyncPlan, results, exist_decks, answered=True):
+        # answered is whether Anki answered every action, when it did not what
+        # failed is queued and the decks are left alone
+        failed = self.commit(plan, results)
+        self.remember_parents()
+        if not failed:
+            self.remember_fingerprint()
+
+        # delete decks left empty by moved and deleted notes
+        if answered:
+            exist_decks = set(exist_decks).union(*map(deck_ancestors, plan.diff.new_decks))
+            self.clean_decks(self.touched_decks(plan.diff), exist_decks)
+
+        # send finish message to SiYuan
+        self.send_finish("\n".join(plan.summary))
+
+    def run_batches(self, sy_notebook, custom_deck, incremental, exist_decks):
+        # sync the cards in slices of batch_size, each one fetched, rendered, sent
+        # and committed before the next, so memory is bounded by the slice; a
+        # checkpoint after each slice lets an interrupted run skip what it committed
+        ids, deleted = self.card_ids(sy_notebook, custom_deck, incremental)
+        key = json.dumps([custom_deck, incremental, self.db.parents_key()])
+        checkpoint = json.loads(self.state.get_meta("checkpoint") or "null")
+        if checkpoint is not None and checkpoint["key"] == key:
+            # cards edited since the interrupted run started are synced again
+            redo = self.db.changed_card_ids(self.since(checkpoint["started"]))
+            failed = set(checkpoint["failed"])
+            redo |= failed
+            ids = [x for x in ids if x > checkpoint["after"] or x in redo]
+            started = checkpoint["started"]
+            logging.info(f"resuming after {checkpoint['after']}, {len(ids)} cards left")
+        else:
+            failed = set()
+            started = datetime.now().strftime("%Y%m%d%H%M%S")
+
+        # revalidate the mirror once, every slice then reads its notes from it
+        self.anki_notes(self._Anki_MODEL, ids=())
+        exist_decks = set(exist_decks)
+        touched = []
+        for batch in chunks(ids, self.batch_size):
+            blocks = self.block_decks(self.db.card_blocks(batch), sy_notebook, custom_deck)
+            sync = self.diff(blocks, [], self.state.notes(batch), exist_decks)
+            plan = self.plan(sync)
+            results = {}
+            down = self.process_invoke(plan, results)
+            failed = (failed - set(batch)) | self.commit(plan, results, watermark=False)
+            touched.extend(self.touched_decks(sync))
+            exist_decks.update(*map(deck_ancestors, sync.new_decks))
+            with self.state.con:
+                self.state.set_meta(
+                    "checkpoint",
+                    json.dumps(
+                        {"key": key, "after": batch[-1], "started": started, "failed": sorted(failed)}
+                    ),
+                )
+            # what failed is queued, the next run goes on from the checkpoint
+            if down is not None:
+                return
+
+        # notes of removed cards go last, only the complete list of cards tells them
+        if deleted:
+            sync = self.diff([], deleted, self.state.notes(deleted), exist_decks)
+            plan = self.plan(sync)
+            results = {}
+            down = self.process_invoke(plan, results)
+            failed |= self.commit(plan, results, watermark=False)
+            if down is not None:
+                return
+            touched.extend(self.touched_decks(sync))
+
+        self.state.advance_watermark()
+        self.remember_parents()
+        with self.state.con:
+            self.state.con.execute("delete from meta where key = 'checkpoint'")
+        if not failed:
+            self.remember_fingerprint()
+        self.clean_decks(touched, exist_decks)
+        self.metrics.summary = [
+            f"num of {x}: {self.metrics.counts[x]}"
+            for x in ["create", "update", "delete"]
+            if self.metrics.counts.get(x)
+        ]
+        self.send_finish("\n".join(self.metrics.summary))
+
+    @measured
+    def run(self, custom_deck=None, incremental=False, force=False):
+        if self.unchanged(custom_deck) and not force:
+            logging.info("SiYuan cards unchanged since the last sync.")
+            self.metrics.status = "unchanged"
+            return
+        if not self.check_procs():
+            self.metrics.status = "offline"
+            return
+
+        # get SiYuan notebooks
+        sy_notebook = self.notebooks()
+        if sy_notebook is None:
+            return
+
         # check Anki model exist
         self.check_anki_model()
 
+        # actions Anki did not take on earlier runs
+        if not self.replay(force):
+            return
+
         # get Anki decks
-        resp = requests.post(self._Anki_URL, json={"action": "deckNames", "version": 6})
-        exist_decks = pd.Series(resp.json()["result"], name="deck").to_frame()
+        exist_decks = self.anki.invoke("deckNames")
 
-        sql = "select * from refs where content like '%card%'"
-        refs = pd.read_sql(sql, con=self.con)
-        if refs.empty:
-            logging.warning("SiYuan does not any card.")
+        incremental = self.incremental(incremental)
+        if self.batch_size:
+            return self.run_batches(sy_notebook, custom_deck, incremental, exist_decks)
+        fetched = self.fetch(sy_notebook, custom_deck, incremental)
+        if fetched is None:
             return
-        block_ids = tuple(refs["block_id"].tolist())
-        if len(block_ids) == 1:
-            block_ids = f'("{block_ids[0]}")'
-        sql = f"select * from blocks where id in {block_ids}"
-        blocks = pd.read_sql(sql, self.con)
-        blocks = blocks.merge(sy_notebook, how="left", on="box")
-        blocks["deck"] = (blocks["boxName"] + blocks["hpath"])
-        if custom_deck is not None:
-            custom_deck = custom_deck.strip("/")
-            blocks.loc[blocks['deck'].str.startswith(custom_deck), "deck"] = custom_deck
-        blocks['deck'] = blocks['deck'].str.replace("/", "::")
-
-        exists = self.anki_notes(self._Anki_MODEL)
-        delete = exists[~exists["id"].isin(blocks["id"])]
-        remain = exists[exists["id"].isin(blocks["id"])]
-        create = blocks[~blocks["id"].isin(remain["id"])]
-
-        new_decks = pd.Series([], name="deck", dtype=str)
-        media = pd.DataFrame([], columns=["markdown", "parent_markdown"])
-
-        # add params to actions_json for creating notes
-        if not create.empty:
-            self.summary.append(f"num of create: {len(create)}")
-            # when child blocks changed, parent blocks must be updated.
-            create = self.merge_parent_blocks(create)
-            self.add_notes(create)
-            media = pd.concat([media, create[["markdown", "parent_markdown"]]])
-            new_decks = pd.concat([new_decks, create["deck"]], ignore_index=True)
-
-        if not remain.empty:
-            remain = remain.merge(blocks, how="left", on="id")
-            remain = self.merge_parent_blocks(remain)
-            # todo only update deck field
-            notes_to_update = remain[
-                (remain["note_hash"] != remain["hash"])
-                | (remain["note_deck"] != remain["deck"])
-                | (remain["note_parent_hash"] != remain["parent_hash"])
-            ].copy()
-            # notes_to_update = remain
-            decks_to_update = remain[remain["note_deck"] != remain["deck"]]
-            self.summary.append(f"num of update: {len(notes_to_update)}")
-            if not notes_to_update.empty:
-                self.update_notes(notes_to_update)
-                media = pd.concat(
-                    [media, notes_to_update[["markdown", "parent_markdown"]]]
-                )
-            if not decks_to_update.empty:
-                self.update_deck(decks_to_update)
-                new_decks = pd.concat(
-                    [new_decks, decks_to_update["deck"]], ignore_index=True
-                )
+        sync = self.diff(*fetched, self.anki_notes(self._Anki_MODEL), exist_decks)
+        plan = self.plan(sync)
+
+        # do all requests
+        results = {}
+        down = self.process_invoke(plan, results)
+        self.finish(plan, results, exist_decks, down is None)
 
-        # add params to actions_json for deleting notes
-        if not delete.empty:
-            self.summary.append(f"num of delete: {len(delete)}")
-            self.delete_notes(delete)
+    @measured
+    def run_async(self, custom_deck=None, incremental=False, force=False, queue_size=2):
+        import asyncio
 
-        # add params to actions_json for creating decks
-        new_decks = pd.Series(
-            new_decks[~new_decks.isin(exist_decks["deck"])].unique(), name="deck"
+        return asyncio.run(
+            self._run_async(custom_deck, incremental, force, queue_size)
         )
-        if not new_decks.empty:
-            self.create_deck(new_decks)
 
-        # add params to actions_json for adding media
-        if not media.empty:
-            self.media_from_blocks(media)
+    async def _run_async(self, custom_deck, incremental, force, queue_size):
+        # same sync as run, but independent reads are issued at once and rendered
+        # chunks are written to Anki while the next ones are still rendering
+        import asyncio
 
-        # do all requests
-        self.process_invoke()
+        if self.unchanged(custom_deck) and not force:
+            logging.info("SiYuan cards unchanged since the last sync.")
+            self.metrics.status = "unchanged"
+            return
+        if not self.check_procs():
+            self.metrics.status = "offline"
+            return
+        incremental = self.incremental(incremental)
+        if not await asyncio.to_thread(self.replay, force):
+            return
 
-        # get Anki decks and delete unused decks
-        resp = requests.post(self._Anki_URL, json={"action": "deckNames", "version": 6})
-        exist_decks = pd.Series(resp.json()["result"], name="deck").to_frame()
-        del_deck = self.get_deck_info(exist_decks)
-        if del_deck:
-            self.delete_decks(del_deck)
+        async def fetch():
+            # fetch and anki_notes both use the SiYuan and state connections, one
+            # after the other, only the plain Anki requests overlap with them
+            sy_notebook = await asyncio.to_thread(self.notebooks)
+            if sy_notebook is None:
+                return None, None
+            fetched = await asyncio.to_thread(self.fetch, sy_notebook, custom_deck, incremental)
+            if fetched is None:
+                return None, None
+            return fetched, await asyncio.to_thread(self.anki_notes, self._Anki_MODEL)
+
+        (fetched, exists), _, exist_decks = await asyncio.gather(
+            fetch(),
+            asyncio.to_thread(self.check_anki_model),
+            asyncio.to_thread(self.anki.invoke, "deckNames"),
+        )
+        if fetched is None:
+            return
+        sync = self.diff(*fetched, exists, exist_decks)
+        plan = self.plan(sync, render=False)
+
+        results = {}
+        down = await asyncio.to_thread(self.process_invoke, plan, results, ["createDeck"])
+        queue = asyncio.Queue(maxsize=queue_size)
+        # the notes are only rendered in chunks, the retry queue needs their actions
+        sent = {}
+
+        async def produce():
+            # the end is always queued, a failed render is raised by awaiting the task
+            try:
+                for act, notes, build in [
+                    ("addNotes", sync.create, self.add_notes),
+                    ("updateNoteFields", sync.update, self.update_notes),
+                ]:
+                    for i in range(0, len(notes), self.anki.chunk_size):
+                        chunk = notes[i : i + self.anki.chunk_size]
+                        await queue.put((act, await asyncio.to_thread(build, chunk)))
+            finally:
+                await queue.put(None)
+
+        async def consume():
+            nonlocal down
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                act, actions = item
+                done, down = await asyncio.to_thread(self.send, act, actions, down)
+                results.setdefault(act, []).extend(done)
+                sent.setdefault(act, []).extend(actions)
+
+        producer = asyncio.create_task(produce())
+        try:
+            await consume()
+        except BaseException:
+            producer.cancel()
+            raise
+        await producer
+        rest = [x for x in self.invoke_order if x != "createDeck"]
+        down = await asyncio.to_thread(self.process_invoke, plan, results, rest, down)
+        plan = replace(plan, actions=MappingProxyType({**plan.actions, **sent}))
+        await asyncio.to_thread(self.finish, plan, results, exist_decks, down is None)
 
-        # send finish message to SiYuan
-        self.send_finish("\n".join(self.summary))
+
+def load_config(path):
+    # {"workspaces": [{"path": ..., "name": ..., "port": 6806, "include": [box ids],
+    #   "exclude": [box ids], "decks": {box id: deck}, "custom_deck": ..., "state": ...,
+    #   "renderer": ..., "siyuan_source": "db" or "http"}]}
+    workspaces = json.loads(Path(path).read_text(encoding="utf-8")).get("workspaces") or []
+    for x in workspaces:
+        # names end up in anki tags, which have no spaces
+        x["name"] = re.sub(r"\s+", "_", str(x.get("name") or Path(x["path"]).name))
+    names = [x["name"] for x in workspaces]
+    if not workspaces or len(set(names)) < len(names):
+        raise ValueError("needs a list of workspaces with distinct names")
+    return workspaces
+
+
+def with_suffix(path, suffix):
+    # syak.prom -> syak-name.prom
+    if not path or not suffix:
+        return path
+    path = Path(path)
+    return str(path.with_name(f"{path.stem}{suffix}{path.suffix}"))
+
+
+def sync(syak, path, custom_deck, args):
+    # sync one workspace once, every interval seconds or whenever it changes;
+    # batches and packages are already sent one after another, --async does not
+    # apply to them
+    sequential = args.batch_size or args.bootstrap
+    sync_run = syak.run_async if args.use_async and not sequential else syak.run
+
+    def run():
+        sync_run(custom_deck, incremental=args.incremental, force=args.force)
+
+    def safe_run():
+        # a failed run is logged and counted, the next one is still tried
+        try:
+            run()
+        except Exception:
+            logging.exception(f"sync of {path} failed")
+            syak.metrics.status = "failed"
+
+    if args.watch:
+        watcher = Watcher(path, debounce=args.debounce, poll=args.interval or 5)
+        while True:
+            safe_run()
+            watcher.wait()
+    elif args.interval:
+        import schedule
+
+        # a scheduler of its own, every workspace is synced in its own thread
+        scheduler = schedule.Scheduler()
+        scheduler.every(args.interval).seconds.do(safe_run)
+        while True:
+            scheduler.run_pending()
+            time.sleep(1)
+    else:
+        run()
 
 
 def main():
@@ -610,29 +2699,197 @@ def main():
         "--path",
         help="path of your SiYuan data",
         dest="SiYuan_data_path",
-        required=True,
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="JSON file listing the workspaces to sync at once, instead of -p",
+        default=None,
     )
     parser.add_argument("-i", "--interval", help="interval of sync(seconds)", default=None, type=int)
+    parser.add_argument(
+        "-w",
+        "--watch",
+        help="sync whenever SiYuan changes, polls every interval seconds without inotify",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--debounce",
+        help="seconds without changes before a watch sync starts",
+        default=2.0,
+        type=float,
+    )
     parser.add_argument("--SiYuanPort", help="port of SiYuan", default=6806)
     parser.add_argument("--ANKIPort", help="port of Anki", default=8765)
     parser.add_argument(
         "--model", help="model of Anki", default="SiYuanModel", dest="Anki_model"
     )
     parser.add_argument("--custom_deck", help="custom deck name", default=None)
+    parser.add_argument(
+        "--parent-depth",
+        help="levels of containers to walk up for the back of a card",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--parent-types",
+        help="comma separated block types the back can be, default l,i,b,s",
+        default=None,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="only sync blocks changed since the last run",
+        action="store_true",
+    )
+    parser.add_argument("--state", help="path of the sync state file", default=None)
+    parser.add_argument(
+        "--force",
+        help="sync even if SiYuan looks unchanged since the last sync",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--render-cache-size",
+        help="size limit of the render cache(MB), 0 to disable",
+        default=64,
+        type=int,
+    )
+    parser.add_argument(
+        "--renderer",
+        help="markdown renderer, the others are faster but need to be installed",
+        default="markdown2",
+        choices=list(RENDERERS),
+    )
+    parser.add_argument(
+        "--siyuan-source",
+        help="read SiYuan's index from siyuan.db or through its /api/query/sql",
+        default="db",
+        choices=["db", "http"],
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of processes rendering markdown for large syncs",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--anki-chunk-size",
+        help="max number of actions sent to Anki in one request",
+        default=200,
+        type=int,
+    )
+    parser.add_argument(
+        "--anki-pause",
+        help="pause between two requests to Anki(seconds)",
+        default=0.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--async",
+        help="overlap SiYuan reads, rendering and Anki writes",
+        action="store_true",
+        dest="use_async",
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="sync this many cards at a time and resume interrupted runs, 0 for all at once",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--max-retries",
+        help="attempts at an action Anki failed before giving up on it, retried with backoff",
+        default=5,
+        type=int,
+    )
+    parser.add_argument(
+        "--bootstrap",
+        help="add new notes by importing one generated .apkg instead of one by one",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="append the metrics of every run as a JSON line to this file, - for stdout",
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        help="write the metrics of the last run to this Prometheus textfile",
+        default=None,
+    )
+    parser.add_argument(
+        "--profile",
+        help="dump cProfile and tracemalloc stats of every run to this directory",
+        default=None,
+    )
     args = parser.parse_args()
-    path = Path(args.SiYuan_data_path)
-    if not path.exists() or not path.is_dir():
-        logging.error("SiYuan path does not exists.")
-        exit()
-    syak = SYAK(args.SiYuan_data_path, args.SiYuanPort, args.ANKIPort, args.Anki_model)
-    if args.interval:
-        schedule.every(args.interval).seconds.do(syak.run, custom_deck=args.custom_deck)
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+    if args.config:
+        try:
+            workspaces = load_config(args.config)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"config {args.config}: {e}")
+            exit()
+    elif args.SiYuan_data_path:
+        workspaces = [{"path": args.SiYuan_data_path, "state": args.state}]
+    else:
+        parser.error("one of -p/--path or -c/--config is required")
+
+    # every workspace has its own state, all of them write to Anki through one lock
+    anki_lock = threading.Lock()
+    sources = []
+    for ws in workspaces:
+        path = Path(ws["path"])
+        if not path.exists() or not path.is_dir():
+            logging.error(f"SiYuan path {path} does not exists.")
+            exit()
+        name = ws.get("name")
+        renderer = ws.get("renderer", args.renderer)
+        if renderer not in RENDERERS or importlib.util.find_spec(RENDERERS[renderer]) is None:
+            logging.error(f"renderer {renderer} is not installed.")
+            exit()
+        state = ws.get("state")
+        if state is None and name is not None:
+            state = default_state_path(path, f"{args.Anki_model}|{name}")
+        suffix = f"-{name}" if name and len(workspaces) > 1 else ""
+        syak = SYAK(
+            str(path),
+            ws.get("port", args.SiYuanPort),
+            args.ANKIPort,
+            args.Anki_model,
+            state_path=state,
+            render_cache_size=args.render_cache_size,
+            workers=args.workers,
+            anki_chunk_size=args.anki_chunk_size,
+            anki_pause=args.anki_pause,
+            metrics_json=args.metrics_json,
+            # one textfile and profile directory per workspace
+            metrics_prom=with_suffix(args.metrics_prom, suffix),
+            profile_dir=with_suffix(args.profile, suffix),
+            batch_size=args.batch_size,
+            bootstrap=args.bootstrap,
+            parent_depth=args.parent_depth,
+            parent_types=args.parent_types.split(",") if args.parent_types else None,
+            include=ws.get("include"),
+            exclude=ws.get("exclude"),
+            notebook_decks=ws.get("decks"),
+            source=name,
+            anki_lock=anki_lock,
+            renderer=renderer,
+            siyuan_source=ws.get("siyuan_source", args.siyuan_source),
+            max_retries=args.max_retries,
+        )
+        sources.append((syak, path, ws.get("custom_deck", args.custom_deck)))
+
+    if len(sources) == 1:
+        sync(*sources[0], args)
     else:
-        syak.run(args.custom_deck)
-    print("\n".join(syak.summary))
+        threads = [threading.Thread(target=sync, args=(*x, args)) for x in sources]
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+    for syak, _, _ in sources:
+        if syak.history:
+            print("\n".join(syak.history[-1]["summary"]))
 
 
 if __name__ == "__main__":